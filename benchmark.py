@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "Benchmark of main.py stages on synthetic SIOPE data"
+
+__author__ = "Massimiliano Scotti"
+__license__ = "MIT License"
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import main
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# FUNCTIONS
+
+# generate(): writes synthetic SIOPE_ANAGRAFICHE.zip, SIOPE_ENTRATE.YYYY.zip and SIOPE_USCITE.YYYY.zip
+# in a csvfiles directory, with the same columns of the files downloaded from Siope.it
+
+# run_stage(): times a stage of main.py (table_to_collection, build_collection_mdb, build_timeseries,
+# build_rollups) and measures rows/s, peak RSS and round-trips to the database per fact row
+
+# Backends:
+# mongod: a running mongod (--host, --port), the data is written in the siope_benchmark database
+# mongomock: in-process stand-in, every process of main.py is run inline
+
+COMPARTI = ['SAN', 'REG', 'PRO', 'COM']
+
+# Fraction of fact rows whose codice gestionale is not in CODGEST_* (dropped by the join)
+CODGEST_MISS = 0.01
+
+
+def write_zip(path, members):
+    # members: {name: list of rows}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name, rows in sorted(members.items()):
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                for row in rows:
+                    writer.writerow(row)
+            zfile.write(tmp, name)
+            os.remove(tmp)
+
+
+def generate(directory, enti, codgest, years, rows, seed=0):
+    # enti: number of enti, codgest: codici gestionali for each comparto,
+    # rows: fact rows of each year for ENTRATE and for USCITE
+    rnd = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    regioni = ['%02d' % r for r in range(1, 6)]
+    province = ['P%02d' % p for p in range(20)]
+    comuni = [('%06d' % c, province[c % len(province)]) for c in range(200)]
+    sottocomparti = [(comparto + str(s), comparto) for comparto in COMPARTI for s in range(2)]
+
+    anagrafiche = {
+        'ANAG_COMPARTI.csv': [(c, 'Comparto ' + c) for c in COMPARTI],
+        'ANAG_SOTTOCOMPARTI.csv': [(s, 'Sottocomparto ' + s, c) for s, c in sottocomparti],
+        'ANAG_REG_PROV.csv': [('NORD', regioni[i % len(regioni)], 'Regione ' + regioni[i % len(regioni)],
+                               p, 'Provincia ' + p) for i, p in enumerate(province)],
+        'ANAG_COMUNI.csv': [(c, 'Comune ' + c, p) for c, p in comuni],
+    }
+
+    ente_rows = []
+    for e in range(enti):
+        comune, provincia = comuni[rnd.randrange(len(comuni))]
+        sottocomparto = sottocomparti[rnd.randrange(len(sottocomparti))][0]
+        ente_rows.append(('%09d' % e, '2010-01-01', '', '%011d' % e, 'Ente %d' % e, comune, provincia,
+                          rnd.randrange(100000), sottocomparto))
+    anagrafiche['ANAG_ENTI_SIOPE.csv'] = ente_rows
+
+    codici = ['%04d' % (1000 + g) for g in range(codgest)]
+    for kind in ('ENTRATE', 'USCITE'):
+        anagrafiche['ANAG_CODGEST_%s.csv' % kind] = [(g, c, 'Codice %s %s' % (g, c), '2010-01-01', '')
+                                                    for c in COMPARTI for g in codici]
+    write_zip(os.path.join(directory, 'SIOPE_ANAGRAFICHE.zip'), anagrafiche)
+
+    # facts have a unique natural key (COD_ENTE, ANNO, PERIODO, COD_GEST)
+    per_ente = max(1, min(codgest, rows // (12 * enti) + 1))
+    for year in years:
+        for kind in ('ENTRATE', 'USCITE'):
+            facts = []
+            for periodo in range(1, 13):
+                for e in range(enti):
+                    for g in rnd.sample(range(codgest), per_ente):
+                        if len(facts) == rows:
+                            break
+                        codice = codici[g] if rnd.random() >= CODGEST_MISS else '9999'
+                        facts.append(('%09d' % e, year, periodo, codice, rnd.randrange(1, 10 ** 9)))
+            write_zip(os.path.join(directory, 'SIOPE_%s.%d.zip' % (kind, year)),
+                      {'%s_%d.csv' % (kind, year): facts})
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on Mac OS X, kilobytes on Linux
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class InlineProcess(object):
+    # multiprocessing.Process running the target in the current process
+
+    def __init__(self, target=None, args=(), kwargs=None):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.exitcode = None
+
+    def start(self):
+        self.target(*self.args, **self.kwargs)
+        self.exitcode = 0
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return False
+
+    def terminate(self):
+        pass
+
+
+class InlineMultiprocessing(object):
+    Process = InlineProcess
+
+    @staticmethod
+    def cpu_count():
+        return 1
+
+
+class Counter(object):
+    def __init__(self):
+        self.requests = 0
+
+
+class CountingBulk(object):
+    def __init__(self, bulk, counter):
+        self._bulk = bulk
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._bulk, name)
+        if name == 'execute':
+            self._counter.requests += 1
+        return attr
+
+
+class CountingCollection(object):
+    # Counts one round-trip for each command sent through the collection
+    # (cursor batches after the first one are not counted)
+
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._collection[name], self._counter)
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if name.startswith('initialize_'):
+                return CountingBulk(result, self._counter)
+            if name == 'with_options':
+                return CountingCollection(result, self._counter)
+            self._counter.requests += 1
+            return result
+        return call
+
+
+class CountingDatabase(CountingCollection):
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        # collections are callable too
+        if hasattr(attr, 'find'):
+            return CountingCollection(attr, self._counter)
+        return CountingCollection.__getattr__(self, name)
+
+
+def use_mongomock(counter):
+    import mongomock
+
+    db = mongomock.MongoClient()[main.database]
+    main.mp = InlineMultiprocessing
+    main.get_connection = lambda: CountingDatabase(db, counter)
+
+
+def server_requests(counter):
+    if counter is not None:
+        return counter.requests
+    # the serverStatus command is counted too
+    return main.get_connection().command('serverStatus')['network']['numRequests']
+
+
+def run_stage(name, function, fact_rows, counter):
+    print('*** BENCHMARK: %s ***' % name)
+    requests = server_requests(counter)
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    round_trips = server_requests(counter) - requests - (0 if counter is not None else 1)
+
+    return {'stage': name,
+            'seconds': round(seconds, 3),
+            'rows': fact_rows,
+            'rows_per_s': round(fact_rows / seconds, 1) if seconds else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'round_trips': round_trips,
+            'round_trips_per_row': round(float(round_trips) / fact_rows, 4) if fact_rows else None}
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Benchmark main.py stages on synthetic SIOPE data')
+    parser.add_argument('--backend', action='store', dest='backend', default='mongod',
+                        choices=['mongod', 'mongomock'],
+                        help='(DEFAULT: mongod) Database used, mongomock runs everything in this process')
+    parser.add_argument('--host', action='store', dest='host', default='localhost',
+                        help='(DEFAULT: localhost) Hostname or IP address where mongod is running')
+    parser.add_argument('--port', action='store', dest='port', default='27017',
+                        help='(DEFAULT: 27017) Port used by mongod process')
+    parser.add_argument('--enti', action='store', dest='enti', type=int, default=1000,
+                        help='(DEFAULT: 1000) Number of enti')
+    parser.add_argument('--codgest', action='store', dest='codgest', type=int, default=100,
+                        help='(DEFAULT: 100) Codici gestionali for each comparto')
+    parser.add_argument('--rows', action='store', dest='rows', type=int, default=100000,
+                        help='(DEFAULT: 100000) Rows of each year in ENTRATE and in USCITE')
+    parser.add_argument('--years', action='store', dest='years', nargs='+', default=['2016'],
+                        help='(DEFAULT: 2016) Years generated and loaded')
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=main.workers,
+                        help='(DEFAULT: number of CPUs) --workers of main.py')
+    parser.add_argument('--direct', action='store_true', dest='direct', default=False,
+                        help='--direct of main.py')
+    parser.add_argument('--rollups', action='store_true', dest='rollups', default=False,
+                        help='Run step 4 too')
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline', default=False,
+                        help='Time all the steps as a single stage (load_all), as main.py runs them')
+    parser.add_argument('--engine', action='store', dest='engines', nargs='+', default=['python'],
+                        choices=['python', 'server', 'pandas', 'both'],
+                        help='(DEFAULT: python) --engine of main.py, the stages are run with each engine given '
+                             'on the same data (both is python and server)')
+    parser.add_argument('--seed', action='store', dest='seed', type=int, default=0,
+                        help='(DEFAULT: 0) Seed of the synthetic data')
+    parser.add_argument('--output', action='store', dest='output', default='benchmark.json',
+                        help='(DEFAULT: benchmark.json) JSON file with the results')
+    result = parser.parse_args(sys.argv[1:])
+    engines = []
+    for engine in result.engines:
+        for e in (['python', 'server'] if engine == 'both' else [engine]):
+            if e not in engines:
+                engines.append(e)
+    if result.backend == 'mongomock' and 'server' in engines:
+        parser.error('mongomock does not run the $merge pipelines of --engine=server')
+    if result.direct and 'server' in engines:
+        parser.error('--engine=server can not be used with --direct')
+
+    output = os.path.abspath(result.output)
+    years = main.parse_years(result.years)
+    workdir = tempfile.mkdtemp(prefix='siope_benchmark_')
+    cwd = os.getcwd()
+
+    print('GENERATING DATA in %s' % workdir)
+    generate(os.path.join(workdir, 'csvfiles'), result.enti, result.codgest, years, result.rows, result.seed)
+    fact_rows = 2 * len(years) * result.rows
+
+    main.socket = 'mongodb://' + result.host + ':' + result.port
+    main.database = 'siope_benchmark'
+    main.years = years
+    main.workers = max(1, result.workers)
+    main.direct = result.direct
+
+    if result.pipeline:
+        stages = [('load_all', lambda: main.load_all(download=False, facts=main.staged_facts(),
+                                                     rollup_years=years if result.rollups else None))]
+    else:
+        stages = [('table_to_collection', lambda: main.table_to_collection(download=False, facts=main.staged_facts())),
+                  ('build_collection_mdb', main.build_collection_mdb),
+                  ('build_timeseries', main.build_timeseries)]
+        if result.rollups:
+            stages.append(('build_rollups', lambda: main.build_rollups(years)))
+
+    results = []
+    try:
+        # the same data is loaded from an empty database by each engine
+        for engine in engines:
+            main.engine = engine
+            counter = None
+            if result.backend == 'mongomock':
+                counter = Counter()
+                use_mongomock(counter)
+            else:
+                main.get_connection().client.drop_database(main.database)
+
+            os.chdir(workdir)
+            for name, function in stages:
+                stage = run_stage(name, function, fact_rows, counter)
+                stage['engine'] = engine
+                results.append(stage)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'date': datetime.datetime.today().isoformat(),
+              'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+              'backend': result.backend,
+              'scale': {'enti': result.enti, 'codgest': result.codgest, 'years': years, 'rows': result.rows},
+              'options': {'workers': main.workers, 'direct': main.direct, 'pipeline': result.pipeline},
+              'stages': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for stage in results:
+        print('%(stage)-22s %(engine)-7s %(seconds)10.3f s %(rows_per_s)12s rows/s '
+              '%(round_trips_per_row)10s round-trips/row' % stage)
+    print('Results written in %s' % output)
+
+
+if __name__ == '__main__':
+    main_benchmark()
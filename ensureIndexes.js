@@ -1,21 +1,30 @@
-
 //In this file you can ensure new indexes in order to speed up the aggregations
 
-//In MongoDB 3 the new command to create index is db.collection.createIndex()
-//We use db.collection.ensureIndex() that in MongoDB 3 is an alias to db.collection.createIndex()
-//in order to maintain compatibility with mongo 2
+//main.py creates these indexes (INDEXES in main.py) after loading each collection,
+//so you need this file only for a siope db loaded by older versions of the script.
+//Keep it in sync with INDEXES.
 
 //Use of this file
 
 //In the shell run:
 
-//mongo < ensureIndexes.js
+//mongo siope ensureIndexes.js
+
+db.mdb_enti.createIndex({COD_ENTE:1})
+db.mdb_codgest_entrate.createIndex({COD_GEST:1,COD_CATEG:1})
+db.mdb_codgest_uscite.createIndex({COD_GEST:1,COD_CATEG:1})
+
+//natural key: the rows already stored are rejected
+db.mdb_entrate.createIndex({COD_ENTE:1,ANNO:1,PERIODO:1,COD_GEST:1}, {unique:true})
+db.mdb_uscite.createIndex({COD_ENTE:1,ANNO:1,PERIODO:1,COD_GEST:1}, {unique:true})
+db.mdb_entrate.createIndex({ANNO:1,DESCR_ENTE:1})
+db.mdb_uscite.createIndex({ANNO:1,DESCR_ENTE:1})
 
-//uncomment the following lines
+//{ANNO:1} is a prefix of both
+db.mdb_entrate_mensili.createIndex({ANNO:1,DESCR_ENTE:1})
+db.mdb_uscite_mensili.createIndex({ANNO:1,DESCR_ENTE:1})
+db.mdb_entrate_mensili.createIndex({ANNO:1,COD_COMPARTO:1})
+db.mdb_uscite_mensili.createIndex({ANNO:1,COD_COMPARTO:1})
 
-//use siope2
-//db.mdb_entrate_mensili.ensureIndex({ANNO:1})
-//db.mdb_uscite_mensili.ensureIndex({ANNO:1})
-//db.mdb_uscite.ensureIndex({ANNO:1,DESCR_ENTE:1})
-//db.mdb_uscite_mensili.ensureIndex({ANNO:1,DESCR_ENTE:1})
-//...
\ No newline at end of file
+db.mdb_entrate_rollup.createIndex({DIMENSIONE:1,ANNO:1,TOTALE:-1})
+db.mdb_uscite_rollup.createIndex({DIMENSIONE:1,ANNO:1,TOTALE:-1})
@@ -6,6 +6,9 @@ __author__ = "Massimiliano Scotti"
 __license__ = "MIT License"
 
 import pymongo
+from pymongo.write_concern import WriteConcern
+import bson
+from bson.son import SON
 import csv
 import sys
 import datetime
@@ -15,91 +18,712 @@ import os
 from shutil import copyfileobj
 import zipfile
 import argparse
+import collections
+import contextlib
+import fnmatch
+import io
+import hashlib
+import itertools
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 # try Python 2 import
 try:
-    from urllib import urlretrieve
+    from urllib2 import Request, urlopen, HTTPError
 # else import Python 3 module
 except ImportError:
-    from urllib.request import urlretrieve
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
 
 # FUNCTIONS
 
 # (STEP 1)
-# retrieve data: download, unzip of files from siope website
-# entrate_aggregation()
-# uscite_aggregation()
+# retrieve data: download of zip files from siope website
+# download(): conditional and resumable download of a file, used by retrieve_data
+# find_sources(), open_source(): csv files are read straight from the zip archives, without extracting them
 # csv_*(): map csv rows to mongo documents
+# load_csv(): inserts csv rows with the types of FIELD_TYPES, used by every csv_* function
 # table_to_collection(): calls function above
+# csv_tasks(), mdb_tasks(), timeseries_tasks(), rollup_tasks(): the work of each step as tasks with dependencies
+# run_tasks(): runs tasks in at most --workers processes, each one as soon as its dependencies end
+# load_all(): steps 1-3 (and 4) as a single set of tasks, so independent work of different steps overlaps
 
 # (STEP 2)
 # build_collection_mdb(): creates collections mdb_*, in particular mdb_entrate/uscite
 # where each document is an income or outcome with ente's informations
-# creating_entrate_mdb() and creating_entrate_mdb() (and their helpers)
+# creating_entrate_mdb_helper() and creating_uscite_mdb_helper()
 # are the most important functions called by build_collection_mdb
+# build_enti(), build_codgest(): mdb_enti and mdb_codgest_*, needed by the helpers
+# load_anagrafiche(), enrich_ente(): mdb_enti is joined in memory, missing references are reported
+# load_enti(), load_codgest(), join_fact(): in-process join engine used by the helpers
+# partition_by_id(): splits csv_entrate/csv_uscite in disjoint ranges, one for each worker, stored in the journal
+# stream_facts_mdb(): --direct mode, loads ENTRATE/USCITE csv files straight into mdb_entrate/uscite
+# pandas_facts_mdb(): --engine=pandas, the same load with a chunk of rows converted and joined at once
+# export_facts(): --export, writes the joined rows of each ENTRATE/USCITE csv file as year-partitioned Parquet
+# server_mdb(), server_ts(): --engine=server, the joins of step 2 and the groups of step 3
+# run in mongod as aggregation pipelines, documents are not sent to this script
 
 # build_timeseries(): creates collections entrate/uscite grouping by ente
 # every ente has an array of income or outcome
+# timeseries_docs(): groups mdb_entrate/uscite read in natural key order, one document for each group
+
+# (STEP 4, OPTIONAL)
+# build_rollups(): materializes the totals of mdb_*_mensili by year and ente, regione, provincia,
+# sottocomparto and categoria gestionale in mdb_*_rollup, used by the *Rollup queries of queries.js
+
+# (WRITES)
+# write_documents(): every loader and builder inserts its documents in unordered insert_many batches,
+# sized by --batch-size, by bytes and by the latency of the previous batch, with the --w/--j write concern
+# process_memory(), batch_bytes(), cache_entries(): with --max-memory the batches, the pandas chunks and
+# the dimension lookups of each process are sized to fit its share
+
+# build_name(), publish(): collections rebuilt from scratch are written without indexes,
+# the indexes are created when they are complete and with --shadow they replace the live ones
+# build_indexes(): creates the INDEXES of a collection after its load, ensureIndexes.js has the same indexes
+
+# (METRICS)
+# new_metrics(), counted(), insert_batch(), finish_metrics(): every loader and builder counts the rows read,
+# inserted and dropped and the bulk latency, prints a progress line every --progress seconds
+# and stores its final counters in the metrics collection
+# report_metrics(): summary of the run by collection and worker, optionally as JSON and Prometheus text file
+# mark_refreshed(): stamp of the end of the run, the cached results of queries.py are dropped when it changes
+
+# (RESUME)
+# start_journal(), run_task(), resumed(): the journal collection records the arguments of the run, the tasks ended
+# and the rows inserted by each loader, so main.py --resume continues a run that failed where it stopped
+
+# (INCREMENTAL REFRESH)
+# refresh_incremental(): fingerprints csv files against the manifest collection and replaces
+# only the ANNO/PERIODO buckets of mdb_* and mdb_*_mensili whose rows changed
 
 # This is a global variable that defines socket where mongod process is waiting for new connections
 socket = None
 
+# Database populated by the script (benchmark.py uses its own)
+database = 'siope'
+
+# MongoClient of this process (get_connection()) and the pid and socket it was created for
+client = None
+client_key = None
+client_lock = threading.Lock()
+
+# Identifies the documents of the metrics collection written by this run
+run_id = None
+
+# Continue the interrupted run recorded in the journal collection (--resume)
+resume = False
+
+# Name of the task run by this process (run_task()), the key of its progress in the journal
+current_task = None
+
+# Seconds between two progress lines of each loader (--progress)
+progress_interval = 30.0
+
+# Where zip files are downloaded from (--url), a local HTTP server can be used for tests
+siope_url = 'https://www.siope.it/Siope2Web/documenti/siope2/open/last/'
+
+# ETag, Last-Modified and SHA-256 of the downloaded zip files, kept in csvfiles
+DOWNLOAD_CACHE = 'download_cache.json'
+
+# Files downloaded at the same time: siope.it throttles or fails with more connections
+DOWNLOADS = 4
+
+# Years of ENTRATE and USCITE downloaded and loaded (--years)
+years = [2016]
+
+# Number of processes used to load the years and to build mdb_entrate and mdb_uscite (--workers)
+workers = mp.cpu_count()
+
+# Load ENTRATE/USCITE csv files straight into mdb_entrate/mdb_uscite (--direct)
+direct = False
+
+# Store csv_entrate/csv_uscite documents with the short keys of SHORT_KEYS (--short-keys)
+short_keys = False
+
+# Largest batch of documents inserted with one insert_many (--batch-size)
+batch_size = 50000
+
+# Write concern of the inserts (--w, --j), None is the default of mongod
+write_w = None
+write_j = None
+
+# Insert each batch in a background thread while the next one is read (--write-thread)
+write_thread = False
+
+# A batch holds about BATCH_BYTES of BSON at most, it is halved when its insert takes more than BATCH_SECONDS
+# and doubled (up to --batch-size) when it takes less than a quarter of it
+BATCH_BYTES = 16 * 1024 * 1024
+BATCH_SECONDS = 2.0
+
+# Memory of the processes running at once (--max-memory, in bytes), None for no limit. Each of the --workers
+# processes gets an equal share (process_memory()): half of it for its batches of documents (batch_bytes()),
+# a quarter for the mdb_enti and mdb_codgest_* lookups (cache_entries()), the rest is headroom
+max_memory = None
+BATCH_SHARE = 0.5
+DIMENSION_SHARE = 0.25
+
+# Memory of a task process before it reads anything (interpreter, modules, MongoClient), more with pandas
+PROCESS_MEMORY = 32 * 1024 * 1024
+PANDAS_PROCESS_MEMORY = 128 * 1024 * 1024
+
+# Bytes of memory of a document held by this script for each byte of its BSON encoding
+# (about 2.4 measured on mdb_entrate documents)
+MEMORY_PER_BSON_BYTE = 3
+
+# Rebuild csv_*, mdb_codgest_* and mdb_*_mensili in <name>_shadow collections and rename them
+# over the live ones when complete, so queries never see them empty or partial (--shadow)
+shadow = False
+SHADOW_SUFFIX = '_shadow'
+
+# Engine of steps 2 and 3 (--engine): 'python' joins and groups the documents in this script,
+# 'server' runs aggregation pipelines in mongod ($merge needs MongoDB 4.2),
+# 'pandas' loads mdb_entrate/mdb_uscite from the csv files a chunk of rows at a time (pandas_facts_mdb())
+engine = 'python'
+
+# _id of the document of the refresh collection written at the end of each run (mark_refreshed())
+REFRESH_ID = 'LAST'
+
+# Directory of the Parquet export of mdb_entrate and mdb_uscite (--export), None for no export
+export_dir = None
+
+# Globals set by main() (or benchmark.py) that the task processes need: they are passed to run_task(),
+# since with the spawn start method (Windows, Mac OS X with Python 3.8+) a process imports the module again
+SETTINGS = ['socket', 'database', 'run_id', 'resume', 'progress_interval', 'siope_url', 'years', 'workers',
+            'direct', 'short_keys', 'batch_size', 'write_w', 'write_j', 'write_thread', 'max_memory', 'shadow',
+            'engine', 'export_dir']
+
+# Columns of ENTRATE_*.csv and USCITE_*.csv files
+FACT_FIELDNAMES = ['COD_ENTE', 'ANNO', 'PERIODO', 'CODICE_GESTIONALE', 'IMP_USCITE_ATT']
+
+# Natural key of mdb_entrate and mdb_uscite documents
+FACT_KEY = [('COD_ENTE', pymongo.ASCENDING), ('ANNO', pymongo.ASCENDING),
+            ('PERIODO', pymongo.ASCENDING), ('COD_GEST', pymongo.ASCENDING)]
+
+# DIMENSIONE of mdb_entrate_rollup and mdb_uscite_rollup documents -> field of mdb_*_mensili documents
+ROLLUP_DIMENSIONS = [('ENTE', '$DESCR_ENTE'),
+                     ('REGIONE', '$DESCR_REGIONE'),
+                     ('PROVINCIA', '$DESCR_PROVINCIA'),
+                     ('SOTTOCOMPARTO', '$DESCR_SOTTOCOMPARTO'),
+                     ('CATEGORIA', '$IMPORTI.DESCRIZIONE_CG')]
+
+# Indexes of each collection, created by build_indexes() when the collection is loaded.
+# FACT_KEY is unique. The ANNO indexes support the queries of queries.js
+INDEXES = {'mdb_enti': [[('COD_ENTE', pymongo.ASCENDING)]],
+           'mdb_codgest_entrate': [[('COD_GEST', pymongo.ASCENDING), ('COD_CATEG', pymongo.ASCENDING)]],
+           'mdb_codgest_uscite': [[('COD_GEST', pymongo.ASCENDING), ('COD_CATEG', pymongo.ASCENDING)]],
+           'mdb_entrate': [FACT_KEY, [('ANNO', pymongo.ASCENDING), ('DESCR_ENTE', pymongo.ASCENDING)]],
+           'mdb_uscite': [FACT_KEY, [('ANNO', pymongo.ASCENDING), ('DESCR_ENTE', pymongo.ASCENDING)]],
+           'mdb_entrate_mensili': [[('ANNO', pymongo.ASCENDING), ('DESCR_ENTE', pymongo.ASCENDING)],
+                                   [('ANNO', pymongo.ASCENDING), ('COD_COMPARTO', pymongo.ASCENDING)]],
+           'mdb_uscite_mensili': [[('ANNO', pymongo.ASCENDING), ('DESCR_ENTE', pymongo.ASCENDING)],
+                                  [('ANNO', pymongo.ASCENDING), ('COD_COMPARTO', pymongo.ASCENDING)]],
+           'mdb_entrate_rollup': [[('DIMENSIONE', pymongo.ASCENDING), ('ANNO', pymongo.ASCENDING),
+                                   ('TOTALE', pymongo.DESCENDING)]],
+           'mdb_uscite_rollup': [[('DIMENSIONE', pymongo.ASCENDING), ('ANNO', pymongo.ASCENDING),
+                                  ('TOTALE', pymongo.DESCENDING)]]}
+
+# mdb_entrate_mensili and mdb_uscite_mensili group facts by the first three fields of FACT_KEY
+# and move these fields of each fact in the IMPORTI array
+IMPORTO_FIELDS = ['COD_GEST', 'DESCRIZIONE_CG', 'IMPORTO', 'DATA_INIZIO_VALIDITA', 'DATA_FINE_VALIDITA']
+
+# Sum of the IMPORTI of a mdb_*_mensili document in a pipeline: its TOTALE, summed in place
+# for the documents stored by older versions (--incremental does not replace them)
+MENSILI_TOTALE = {'$ifNull': ['$TOTALE', {'$sum': '$IMPORTI.IMPORTO'}]}
+
+# Fields of mdb_enti documents copied in mdb_entrate and mdb_uscite documents (--engine=server)
+ENTE_FIELDS = ['COD_ENTE', 'DATA_INC_SIOPE', 'DATA_ESC_SIOPE', 'COD_FISCALE', 'DESCR_ENTE', 'COD_COMUNE',
+               'COD_PROVINCIA', 'NUM_ABITANTI', 'COD_SOTTOCOMPARTO', 'DESCR_SOTTOCOMPARTO', 'COD_COMPARTO',
+               'DESCR_COMPARTO', 'DESCR_PROVINCIA', 'DESCR_REGIONE', 'COD_REGIONE', 'RIPART_GEO', 'DESCR_COMUNE']
+
+# Columns of the Parquet files written by export_facts(): the fields of mdb_entrate/mdb_uscite documents
+# but _id and ANNO, which is in the directory name (ANNO=2016). The string columns, ente and codgest fields,
+# are dictionary-encoded: a few thousand distinct values repeated in millions of rows
+EXPORT_COLUMNS = ['PERIODO', 'IMPORTO', 'COD_GEST', 'DESCRIZIONE_CG', 'DATA_INIZIO_VALIDITA',
+                  'DATA_FINE_VALIDITA'] + ENTE_FIELDS
+EXPORT_INTS = ['PERIODO', 'IMPORTO', 'NUM_ABITANTI']
+EXPORT_DATES = ['DATA_INC_SIOPE', 'DATA_ESC_SIOPE']
+
 
 def get_connection():
-	return pymongo.MongoClient(socket).siope
+	# One MongoClient, and so one connection pool, for each process: a client is not used after a fork,
+	# the task processes create their own
+	# the process of queries.py may call it from several threads
+	global client, client_key
+	with client_lock:
+		if client is None or client_key != (os.getpid(), socket):
+			client = pymongo.MongoClient(socket)
+			client_key = (os.getpid(), socket)
+		return client[database]
+
+
+def build_name(name):
+    # Collection where name is rebuilt: name itself or, with --shadow, its shadow collection
+    return name + SHADOW_SUFFIX if shadow else name
+
+
+def build_indexes(name, collection=None):
+    # Creates the INDEXES of name on collection (DEFAULT: name)
+    if collection is None:
+        collection = get_connection()[name]
+    for keys in INDEXES.get(name, []):
+        if keys is FACT_KEY:
+            ensure_fact_key(collection.name)
+        else:
+            collection.create_index(keys)
+
+
+def publish(name):
+    # Creates the indexes of a rebuilt collection, after the load, and with --shadow
+    # renames the shadow collection over name (an empty shadow collection may not exist)
+    db = get_connection()
+    collection = db[build_name(name)]
+    build_indexes(name, collection)
+    if collection.name == name:
+        return
+    print('SWAPPING %s' % name)
+    if collection.name in db.list_collection_names():
+        collection.rename(name, dropTarget=True)
+    else:
+        db[name].drop()
 
 
-def retrieve_data():
-    for f in os.listdir('.'):
-        os.remove(f)
-
-    zips = ['SIOPE_ANAGRAFICHE.zip',
-            'SIOPE_USCITE.2016.zip', 'SIOPE_ENTRATE.2016.zip',
-            'SIOPE_USCITE.2015.zip', 'SIOPE_ENTRATE.2015.zip']
-
-    for z in zips:
-        print('Downloading file %s' % z)
-        url = 'https://www.siope.it/Siope2Web/documenti/siope2/open/last/' + z
-        todownload = True
-        ndownload = 0
-        while todownload == True and ndownload < 10:
+def new_metrics(collection, source=None):
+    # Counters of a loader or builder process writing collection (from source, if given)
+    now = time.time()
+    return {'RUN': run_id, 'COLLECTION': collection, 'SOURCE': source, 'PID': os.getpid(),
+            'read': 0, 'inserted': 0, 'joined': 0, 'ente_miss': 0, 'codgest_miss': 0, 'duplicates': 0,
+            'reference_miss': 0,
+            'bulks': 0, 'bulk_seconds': 0.0, 'bulk_max_seconds': 0.0, 'position': None,
+            'start': now, 'progress_at': now}
+
+
+def metrics_label(stats):
+    label = stats['COLLECTION']
+    if stats['SOURCE'] is not None:
+        label += ' (%s)' % stats['SOURCE']
+    return '%s [pid %d]' % (label, stats['PID'])
+
+
+def skipped(stats):
+    return stats['ente_miss'] + stats['codgest_miss'] + stats['duplicates']
+
+
+def print_progress(stats):
+    now = time.time()
+    if now - stats['progress_at'] < progress_interval:
+        return
+    stats['progress_at'] = now
+    print('PROGRESS %s: %d read, %d inserted, %d skipped, %.0f rows/s'
+          % (metrics_label(stats), stats['read'], stats['inserted'], skipped(stats),
+             stats['read'] / max(now - stats['start'], 1e-6)))
+    # children write on the same stdout
+    sys.stdout.flush()
+
+
+def counted(rows, stats):
+    # Counts the rows read, checking every 1000 rows if a progress line is due
+    for row in rows:
+        stats['read'] += 1
+        if stats['read'] % 1000 == 0:
+            print_progress(stats)
+        yield row
+
+
+def record_bulk(stats, seconds, inserted):
+    stats['bulks'] += 1
+    stats['bulk_seconds'] += seconds
+    stats['bulk_max_seconds'] = max(stats['bulk_max_seconds'], seconds)
+    stats['inserted'] += inserted
+
+
+def insert_batch(collection, batch, stats):
+    # Inserts a batch of documents, unordered, recording its latency and the documents inserted.
+    # Duplicates rejected by a unique index are counted, any other error is raised.
+    # Returns the seconds taken
+    start = time.time()
+    try:
+        # with w=0 the inserts are not acknowledged and all of them are counted
+        collection.insert_many(batch, ordered=False)
+        inserted = len(batch)
+    except pymongo.errors.BulkWriteError as e:
+        errors = e.details['writeErrors']
+        duplicates = len([err for err in errors if err['code'] == 11000])
+        if duplicates != len(errors):
+            raise
+        stats['duplicates'] += duplicates
+        inserted = e.details['nInserted']
+    seconds = time.time() - start
+    record_bulk(stats, seconds, inserted)
+    return seconds
+
+
+def write_concern():
+    options = {}
+    if write_w is not None:
+        options['w'] = write_w
+    if write_j is not None:
+        options['j'] = write_j
+    return WriteConcern(**options)
+
+
+def process_memory():
+    # Bytes a task process may use for its documents with --max-memory, None without it
+    if max_memory is None:
+        return None
+    return max_memory // workers - (PANDAS_PROCESS_MEMORY if engine == 'pandas' else PROCESS_MEMORY)
+
+
+def batch_bytes():
+    # Largest BSON size of a batch: BATCH_BYTES or less, if the batches held by a process (two with --write-thread)
+    # do not fit its share of --max-memory as python documents and as the BSON sent by insert_many()
+    memory = process_memory()
+    if memory is None:
+        return BATCH_BYTES
+    batches = 2 if write_thread else 1
+    return max(1, min(BATCH_BYTES, int(memory * BATCH_SHARE // (batches * (MEMORY_PER_BSON_BYTE + 1)))))
+
+
+def rows_in_memory(document_bytes):
+    # Rows of document_bytes of BSON held at once by a chunk of --engine=pandas or a row group of --export:
+    # --batch-size, fewer if they do not fit a batch_bytes() with --max-memory
+    if max_memory is None:
+        return batch_size
+    return max(1, min(batch_size, int(batch_bytes() // max(document_bytes, 1))))
+
+
+def next_batch_size(size, seconds, document_bytes):
+    # Halved after a slow insert, doubled after a fast one, within --batch-size and batch_bytes()
+    limit = max(1, min(batch_size, int(batch_bytes() // max(document_bytes, 1))))
+    if seconds > BATCH_SECONDS:
+        size //= 2
+    elif seconds < BATCH_SECONDS / 4:
+        size *= 2
+    return max(1, min(size, limit))
+
+
+def write_documents(collection, docs, stats):
+    # Inserts docs in batches of next_batch_size() documents. The size of a document is sampled
+    # (the first of each batch and one every 1000), a batch ends as soon as the samples tell that
+    # it holds more than batch_bytes() of BSON. With --write-thread a batch is inserted
+    # while the next one is read, so at most two batches are held in memory.
+    # If docs come from resumed() rows, the position of the source is journaled after each batch inserted
+    journal = collection.database.journal
+    collection = collection.with_options(write_concern=write_concern())
+    pool = ThreadPool(1) if write_thread else None
+    pending = None
+    pending_position = None
+    size = batch_size
+    samples = 0
+    sampled_bytes = 0
+    batch = []
+    try:
+        for doc in docs:
+            if not batch or len(batch) % 1000 == 0:
+                samples += 1
+                sampled_bytes += len(bson.BSON.encode(doc))
+                # the first batch too, before any insert has sized them
+                size = max(1, min(size, int(batch_bytes() * samples // sampled_bytes)))
+            batch.append(doc)
+            if len(batch) < size:
+                continue
+
+            if pool is None:
+                seconds = insert_batch(collection, batch, stats)
+                checkpoint(journal, stats['position'])
+            else:
+                # waits for the previous batch, its latency sizes the next one
+                seconds = pending.get() if pending is not None else 0.0
+                checkpoint(journal, pending_position)
+                pending = pool.apply_async(insert_batch, (collection, batch, stats))
+                pending_position = stats['position']
+            size = next_batch_size(size, seconds, sampled_bytes / samples)
+            batch = []
+
+        if pending is not None:
+            pending.get()
+            checkpoint(journal, pending_position)
+        if batch:
+            insert_batch(collection, batch, stats)
+        checkpoint(journal, stats['position'])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def resume_position(stats):
+    # Rows of its source inserted by the task of this process in the interrupted run (0 without --resume),
+    # None outside of a task
+    if current_task is None:
+        return None
+    position = 0
+    if resume:
+        doc = get_connection().journal.find_one({'_id': 'rows/' + current_task})
+        position = doc['ROWS'] if doc is not None else 0
+    if position:
+        print('RESUMING %s after %d rows' % (metrics_label(stats), position))
+    return position
+
+
+def resumed(rows, stats):
+    # Source rows of the loader run by a task, always read in the same order. stats['position'] counts the rows
+    # read, write_documents() journals it when their documents are inserted: with --resume the rows inserted
+    # by the interrupted run are skipped
+    position = resume_position(stats)
+    if position is None:
+        for row in rows:
+            yield row
+        return
+
+    if position:
+        # a cursor skips them in mongod
+        rows = rows.skip(position) if hasattr(rows, 'skip') else itertools.islice(rows, position, None)
+    stats['position'] = position
+    for row in rows:
+        stats['position'] += 1
+        yield row
+
+
+def checkpoint(journal, position):
+    # The documents of the first position rows of resumed() are inserted.
+    # If the process dies before this write, the last batch is inserted again by --resume
+    if position is not None:
+        journal.replace_one({'_id': 'rows/' + current_task}, {'_id': 'rows/' + current_task, 'ROWS': position},
+                            upsert=True)
+
+
+def finish_metrics(stats):
+    # Prints the final counters of the process and stores them in the metrics collection
+    stats['end'] = time.time()
+    stats['seconds'] = stats['end'] - stats['start']
+    stats['rows_per_s'] = stats['read'] / max(stats['seconds'], 1e-6)
+    print('%s: %d read, %d inserted, %d dropped (codgest not found), %d dropped (ente not found), '
+          '%d already stored, %.1f s, %.0f rows/s, %d bulks (%.3f s avg, %.3f s max)'
+          % (metrics_label(stats), stats['read'], stats['inserted'], stats['codgest_miss'], stats['ente_miss'],
+             stats['duplicates'], stats['seconds'], stats['rows_per_s'], stats['bulks'],
+             stats['bulk_seconds'] / max(stats['bulks'], 1), stats['bulk_max_seconds']))
+    sys.stdout.flush()
+    doc = dict(stats)
+    del doc['progress_at']
+    get_connection().metrics.insert_one(doc)
+
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def download(url, filename, cache):
+    # Downloads url in filename, returns True if the file changed.
+    # cache[filename] keeps ETag/Last-Modified and SHA-256 of the last download:
+    # an unchanged file is not downloaded again (conditional GET) and an interrupted
+    # download is resumed from filename.part (Range request)
+    entry = cache.setdefault(filename, {})
+    part = filename + '.part'
+
+    for attempt in range(10):
+        headers = {}
+        if os.path.exists(filename) and entry.get('SHA256') == sha256_file(filename):
+            if entry.get('ETag'):
+                headers['If-None-Match'] = entry['ETag']
+            if entry.get('Last-Modified'):
+                headers['If-Modified-Since'] = entry['Last-Modified']
+
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset and entry.get('PART_VALIDATOR'):
+            headers['Range'] = 'bytes=%d-' % offset
+            # the server sends the whole file if it changed since the partial download
+            headers['If-Range'] = entry['PART_VALIDATOR']
+
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
             try:
-                ndownload += 1
-                urlretrieve(url, filename=z)
-            except:
-                if not ndownload < 10:
-                    print('Warning: file %s not downloaded' % z)
+                if response.getcode() == 206:
+                    print('Resuming download of %s from byte %d' % (filename, offset))
+                    mode = 'ab'
+                else:
+                    mode = 'wb'
+                    info = response.info()
+                    entry['ETag'] = info.get('ETag')
+                    entry['Last-Modified'] = info.get('Last-Modified')
+                    entry['PART_VALIDATOR'] = entry['ETag'] or entry['Last-Modified']
+                with open(part, mode) as f:
+                    start = f.tell()
+                    copyfileobj(response, f, 1 << 20)
+                    received = f.tell() - start
+                length = response.info().get('Content-Length')
+                if length is not None and received < int(length):
+                    raise IOError('connection closed after %d of %s bytes' % (received, length))
+            finally:
+                response.close()
+        except HTTPError as e:
+            if e.code == 304:
+                print('File %s not changed' % filename)
+                return False
+            if e.code == 416:
+                # the partial file is not valid anymore
+                os.remove(part)
+                continue
+            if e.code < 500:
+                print('Warning: file %s not downloaded (HTTP %d)' % (filename, e.code))
+                return False
+        except IOError as e:
+            print('Download of %s failed (%s), attempt %d' % (filename, e, attempt + 1))
+        else:
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(part, filename)
+            entry['SHA256'] = sha256_file(filename)
+            return True
+
+        time.sleep(min(60, 2 ** attempt))
+
+    print('Warning: file %s not downloaded' % filename)
+    return False
+
+
+def retrieve_data(url=None):
+    # zip files, partial downloads and the download cache are kept for the next run.
+    # csv files are not extracted: they are read from the archives by open_source()
+    for f in os.listdir('.'):
+        if not f.endswith(('.zip', '.part')) and f != DOWNLOAD_CACHE:
+            os.remove(f)
+
+    zips = ['SIOPE_ANAGRAFICHE.zip']
+    for year in years:
+        zips += ['SIOPE_USCITE.%d.zip' % year, 'SIOPE_ENTRATE.%d.zip' % year]
+
+    cache = {}
+    if os.path.exists(DOWNLOAD_CACHE):
+        with open(DOWNLOAD_CACHE) as f:
+            cache = json.load(f)
+
+    print('Downloading files %s' % ', '.join(zips))
+    pool = ThreadPool(min(len(zips), DOWNLOADS))
+    try:
+        # one file at a time to each thread, the next as soon as it is free
+        pool.map(lambda z: download((url or siope_url) + z, z, cache), zips, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        with open(DOWNLOAD_CACHE, 'w') as f:
+            json.dump(cache, f, indent=1)
+
+
+def find_sources(pattern):
+    # Csv files matching pattern: members of the zip archives in the current directory
+    # ('SIOPE_USCITE.2016.zip/USCITE_2016.csv') and files on disk not found in any archive
+    sources = []
+    members = set()
+    for archive in sorted(glob.glob('*.zip')):
+        try:
+            names = zipfile.ZipFile(archive).namelist()
+        except zipfile.BadZipfile:
+            print('Warning: %s is not a valid zip file' % archive)
+            continue
+        for name in sorted(names):
+            if fnmatch.fnmatch(os.path.basename(name), pattern):
+                sources.append(archive + '/' + name)
+                members.add(os.path.basename(name))
+    sources += [f for f in sorted(glob.glob(pattern)) if f not in members]
+    return sources
+
+
+@contextlib.contextmanager
+def open_source(source, binary=False):
+    # Opens a csv file returned by find_sources() in text mode or, with binary, in binary mode
+    if os.path.exists(source):
+        with open(source, 'rb' if binary else 'r') as csvfile:
+            yield csvfile
+        return
+
+    archive, member = source.split('.zip/', 1)
+    with zipfile.ZipFile(archive + '.zip') as zfile:
+        with zfile.open(member) as raw:
+            if binary or sys.version_info[0] < 3:
+                # bytes: asked for, or read by the csv module of Python 2
+                yield raw
             else:
-                todownload = False
+                yield io.TextIOWrapper(raw)
+
+
+def read_rows(sources, fieldnames):
+    # Rows of all the sources, opened one at a time while they are read. The fields missing in a short row
+    # are None, the extra ones of a long row (csv.DictReader puts them in a list under the key None)
+    # are dropped: documents can only have string keys
+    for source in sources:
+        with open_source(source) as csvfile:
+            for row in csv.DictReader(csvfile, fieldnames=fieldnames):
+                row.pop(None, None)
+                yield row
+
+
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%Y%m%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S']
+
+
+def to_int(value):
+    return int(value or 0)
+
+
+def to_date(value):
+    # None if empty (or missing in a short row), the original string if the format is unknown
+    if not value:
+        return None
+    for fmt in DATE_FORMATS:
         try:
-            zfile = zipfile.ZipFile(z)
-            zfile.extractall()
-            os.remove(z)
-        except:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
             pass
+    return value
+
 
+# Type of the csv fields that are not stored as strings
+FIELD_TYPES = {'ANNO': to_int,
+               'PERIODO': to_int,
+               'IMP_USCITE_ATT': to_int,
+               'NUM_ABITANTI': to_int,
+               'DATA_INC_SIOPE': to_date,
+               'DATA_ESC_SIOPE': to_date}
 
-def entrate_aggregation():
-    print('AGGREGATION OF INPUT...')
-    if os.path.exists('ENTRATE.csv'):
-        os.remove('ENTRATE.csv')
-    entrate = glob.glob('ENTRATE*')
+# Keys stored in csv_entrate and csv_uscite with --short-keys
+SHORT_KEYS = {'COD_ENTE': 'E', 'ANNO': 'A', 'PERIODO': 'P', 'CODICE_GESTIONALE': 'G', 'IMP_USCITE_ATT': 'I'}
+LONG_KEYS = dict((short, key) for key, short in SHORT_KEYS.items())
 
-    with open('ENTRATE.csv', 'w') as output_file:
-        for filename in entrate:
-            with open(filename, 'r') as file:
-                copyfileobj(file, output_file, -1)
 
+def typed_rows(rows, fieldnames):
+    converters = [(field, FIELD_TYPES[field]) for field in fieldnames if field in FIELD_TYPES]
+    for row in rows:
+        for field, convert in converters:
+            row[field] = convert(row[field])
+        yield row
 
-def uscite_aggregation():
-    print('AGGREGATION OF OUTPUT...')
-    if os.path.exists('USCITE.csv'):
-        os.remove('USCITE.csv')
-    uscite = glob.glob('USCITE*')
 
-    with open('USCITE.csv', 'w') as output_file:
-        for filename in uscite:
-            with open(filename, 'r') as file:
-                copyfileobj(file, output_file, -1)
+def expand_keys(doc):
+    # csv_entrate/csv_uscite document with the original field names
+    if not short_keys:
+        return doc
+    return dict((LONG_KEYS.get(key, key), value) for key, value in doc.items())
+
+
+def load_csv(name, sources, fieldnames, keys=None, resumable=False):
+    # Inserts the csv rows in collection name (its shadow with --shadow). keys maps field names to the keys stored.
+    # resumable if the collection is not dropped by this task: --resume skips the rows already inserted
+    db = get_connection()
+    stats = new_metrics(name, ', '.join(sources))
+
+    rows = read_rows(sources, fieldnames)
+    if resumable:
+        rows = resumed(rows, stats)
+    rows = counted(typed_rows(rows, fieldnames), stats)
+    if keys is not None:
+        rows = (dict((keys[field], value) for field, value in row.items()) for row in rows)
+    write_documents(db[build_name(name)], rows, stats)
+
+    finish_metrics(stats)
 
 
 def csv_enti(path):
@@ -107,18 +731,14 @@ def csv_enti(path):
 
     db = get_connection()
 
-    db.csv_enti.drop()
-    bulk = db.csv_enti.initialize_unordered_bulk_op()
+    db[build_name('csv_enti')].drop()
 
     fieldnames = ['COD_ENTE', 'DATA_INC_SIOPE', 'DATA_ESC_SIOPE',
                   'COD_FISCALE', 'DESCR_ENTE', 'COD_COMUNE', 'COD_PROVINCIA',
                   'NUM_ABITANTI', 'SOTTOCOMPARTO_SIOPE']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_enti', [path], fieldnames)
+    publish('csv_enti')
 
 
 def csv_comparti(path):
@@ -126,16 +746,12 @@ def csv_comparti(path):
 
     db = get_connection()
 
-    db.csv_comparti.drop()
-    bulk = db.csv_comparti.initialize_unordered_bulk_op()
+    db[build_name('csv_comparti')].drop()
 
     fieldnames = ['COD_COMPARTO', 'DESCRIZIONE_COMPARTO']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_comparti', [path], fieldnames)
+    publish('csv_comparti')
 
 
 def csv_sottocomparti(path):
@@ -143,66 +759,50 @@ def csv_sottocomparti(path):
 
     db = get_connection()
 
-    db.csv_sottocomparti.drop()
-    bulk = db.csv_sottocomparti.initialize_unordered_bulk_op()
+    db[build_name('csv_sottocomparti')].drop()
 
     fieldnames = ['SOTTOCOMPARTO', 'DESCRIZIONE', 'COD_COMPARTO']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_sottocomparti', [path], fieldnames)
+    publish('csv_sottocomparti')
 
 
 def csv_comuni(path):
     print('CREATING csv_comuni')
 
     db = get_connection()
-    db.csv_comuni.drop()
-    bulk = db.csv_comuni.initialize_unordered_bulk_op()
+    db[build_name('csv_comuni')].drop()
 
     fieldnames = ['COD_COMUNE', 'DESCR_COMUNE', 'COD_PROVINCIA']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_comuni', [path], fieldnames)
+    publish('csv_comuni')
 
 
 def csv_regprov(path):
     print('CREATING csv_regprov')
 
     db = get_connection()
-    db.csv_regprov.drop()
-    bulk = db.csv_regprov.initialize_unordered_bulk_op()
+    db[build_name('csv_regprov')].drop()
 
     fieldnames = ['RIPART_GEO', 'COD_REGIONE', 'DESCRIZIONE REGIONE',
                   'COD_PROVINCIA', 'DESCRIZIONE_PROVINCIA']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_regprov', [path], fieldnames)
+    publish('csv_regprov')
 
 
 def csv_codgest_entrate(path):
     print('CREATING csv_codgest_entrate')
 
     db = get_connection()
-    db.csv_codgest_entrate.drop()
-    bulk = db.csv_codgest_entrate.initialize_unordered_bulk_op()
+    db[build_name('csv_codgest_entrate')].drop()
 
     fieldnames = ['COD_GEST', 'COD_CATEG', 'DESCRIZIONE_CGE',
                   'DATA_INIZIO_VALIDITA', 'DATA_FINE_VALIDITA']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_codgest_entrate', [path], fieldnames)
+    publish('csv_codgest_entrate')
 
 
 def csv_codgest_uscite(path):
@@ -210,376 +810,1019 @@ def csv_codgest_uscite(path):
 
     db = get_connection()
 
-    db.csv_codgest_uscite.drop()
-    bulk = db.csv_codgest_uscite.initialize_unordered_bulk_op()
+    db[build_name('csv_codgest_uscite')].drop()
 
     fieldnames = ['COD_GEST', 'COD_CATEG', 'DESCRIZIONE_CGU',
                   'DATA_INIZIO_VALIDITA', 'DATA_FINE_VALIDITA']
 
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        for row in reader:
-            bulk.insert(row)
-        bulk.execute()
+    load_csv('csv_codgest_uscite', [path], fieldnames)
+    publish('csv_codgest_uscite')
 
 
-def csv_entrate(path):
+def csv_entrate():
+    # the files (years) are loaded by csv_facts(), one task for each file, then published
     print('CREATING csv_entrate')
 
     db = get_connection()
-
-    db.csv_entrate.drop()
-    bulk = db.csv_entrate.initialize_unordered_bulk_op()
-
-    fieldnames = ['COD_ENTE', 'ANNO', 'PERIODO',
-                  'CODICE_GESTIONALE', 'IMP_USCITE_ATT']
-
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        i = 0
-        for row in reader:
-            bulk.insert(row)
-            i += 1
-            if i % 50000 == 0:
-                bulk.execute()
-                bulk = db.csv_entrate.initialize_unordered_bulk_op()
-        try:
-            bulk.execute()
-        except pymongo.errors.InvalidOperation:
-            pass
+    db[build_name('csv_entrate')].drop()
 
 
-def csv_uscite(path):
+def csv_uscite():
+    # the files (years) are loaded by csv_facts(), one task for each file, then published
     print('CREATING csv_uscite')
 
     db = get_connection()
-    db.csv_uscite.drop()
-    bulk = db.csv_uscite.initialize_unordered_bulk_op()
-
-    fieldnames = ['COD_ENTE', 'ANNO', 'PERIODO',
-                  'CODICE_GESTIONALE', 'IMP_USCITE_ATT']
-
-    with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        i = 0
-        for row in reader:
-            bulk.insert(row)
-            i += 1
-            if i % 50000 == 0:
-                bulk.execute()
-                bulk = db.csv_uscite.initialize_unordered_bulk_op()
-        try:
-            bulk.execute()
-        except pymongo.errors.InvalidOperation:
-            pass
+    db[build_name('csv_uscite')].drop()
+
+
+def csv_facts(name, path):
+    # csv_entrate/csv_uscite are dropped by their own task
+    load_csv(name, [path], FACT_FIELDNAMES, SHORT_KEYS if short_keys else None, resumable=True)
+
+
+def fact_files(kind):
+    # kind is 'ENTRATE' or 'USCITE', the years are chosen with --years
+    sources = []
+    for year in years:
+        sources += find_sources('%s_%d*.csv' % (kind, year))
+    return sources
+
+
+def parse_years(values):
+    # ['2010-2014', '2016'] -> [2010, 2011, 2012, 2013, 2014, 2016]
+    result = set()
+    for value in values:
+        for part in value.split(','):
+            if '-' in part:
+                first, last = part.split('-', 1)
+                result.update(range(int(first), int(last) + 1))
+            elif part:
+                result.add(int(part))
+    return sorted(result)
 
 
-def table_to_collection(download=True):
+def prepare_csvfiles(download=True):
     if not os.path.exists('./csvfiles'):
         os.makedirs('./csvfiles')
     os.chdir('csvfiles')
 
     # Scarico i dati aggiornati
-    print('DATA RETRIEVAL AND AGGREGATION OF INPUTS AND OUTPUTS')
-    if download:
+    print('DATA RETRIEVAL')
+    # --resume reads the files of the interrupted run
+    if download and 'retrieve_data' not in journaled_tasks():
         retrieve_data()
+        journal_done('retrieve_data')
 
-    # Aggrego ENTRATE ed USCITE degli ultimi anni
-    entrate_agg = mp.Process(target=entrate_aggregation)
-    uscite_agg = mp.Process(target=uscite_aggregation)
-    entrate_agg.start()
-    uscite_agg.start()
-    entrate_agg.join()
-    uscite_agg.join()
+
+def new_task(name, target, args=(), deps=()):
+    # deps are names of tasks or of groups of tasks: 'csv_entrate' is csv_entrate and every csv_entrate/*
+    return {'name': name, 'target': target, 'args': args, 'deps': list(deps)}
+
+
+def depends_on(task, name):
+    return name != task['name'] and any(name == dep or name.startswith(dep + '/') for dep in task['deps'])
+
+
+def start_journal(args):
+    # The journal collection records the run (its command line arguments), the tasks ended
+    # and the rows inserted by each loader
+    journal = get_connection().journal
+    journal.delete_many({})
+    journal.insert_one({'_id': 'RUN', 'RUN': run_id, 'ARGS': args, 'START': datetime.datetime.utcnow()})
+
+
+def end_journal():
+    get_connection().journal.update_one({'_id': 'RUN'}, {'$set': {'END': datetime.datetime.utcnow()}})
+
+
+def interrupted_run():
+    # The journal of the last run if it did not end, None otherwise
+    run = get_connection().journal.find_one({'_id': 'RUN'})
+    return run if run is not None and 'END' not in run else None
+
+
+def journal_done(name):
+    get_connection().journal.replace_one({'_id': 'task/' + name},
+                                         {'_id': 'task/' + name, 'END': datetime.datetime.utcnow()}, upsert=True)
+
+
+def journaled_tasks():
+    # Names of the tasks ended by the interrupted run (--resume), an empty set otherwise
+    if not resume:
+        return set()
+    return set(doc['_id'][len('task/'):] for doc in get_connection().journal.find({'_id': {'$regex': '^task/'}}))
+
+
+def settings():
+    return dict((name, globals()[name]) for name in SETTINGS)
+
+
+def run_task(task, task_settings):
+    # Body of the process of a task: the task is journaled when its target returns
+    global current_task
+    globals().update(task_settings)
+    current_task = task['name']
+    task['target'](*task['args'])
+    journal_done(task['name'])
+
+
+def run_tasks(tasks, slots=None):
+    # Runs each task in its own process as soon as the tasks it depends on are ended,
+    # with at most slots (DEFAULT: --workers) processes, and so MongoClients, at the same time.
+    # Ready tasks start in list order. Dependencies not in tasks are ended by a previous step.
+    # With --resume the tasks ended by the interrupted run are not run again.
+    # If a task fails the running ones are terminated and RuntimeError is raised
+    slots = max(1, slots or workers)
+    names = [task['name'] for task in tasks]
+    waiting = dict((task['name'], set(name for name in names if depends_on(task, name))) for task in tasks)
+    ended = journaled_tasks() & set(names)
+    for name in names:
+        if name in ended:
+            print('SKIPPING %s: ended by the interrupted run' % name)
+    pending = [task for task in tasks if task['name'] not in ended]
+    running = []
+
+    while pending or running:
+        for task in list(pending):
+            if len(running) == slots:
+                break
+            if waiting[task['name']] <= ended:
+                process = mp.Process(target=run_task, args=(task, settings()))
+                process.start()
+                running.append((task, process))
+                pending.remove(task)
+
+        if not running:
+            raise RuntimeError('Tasks %s wait for each other' % ', '.join(task['name'] for task in pending))
+
+        for task, process in list(running):
+            process.join(0.1)
+            if process.is_alive():
+                continue
+            running.remove((task, process))
+            if process.exitcode != 0:
+                for other, p in running:
+                    p.terminate()
+                    p.join()
+                raise RuntimeError('Task %s failed (exit code %s)' % (task['name'], process.exitcode))
+            ended.add(task['name'])
+
+
+ANAGRAFICHE_TASKS = [('csv_enti', csv_enti, '*ENTI_SIOPE*.csv'),
+                     ('csv_comparti', csv_comparti, '*_COMPARTI*.csv'),
+                     ('csv_sottocomparti', csv_sottocomparti, '*SOTTOCOMPARTI*.csv'),
+                     ('csv_comuni', csv_comuni, '*COMUNI*.csv'),
+                     ('csv_regprov', csv_regprov, '*REG_PROV*.csv'),
+                     ('csv_codgest_entrate', csv_codgest_entrate, '*CODGEST_ENTRATE*.csv'),
+                     ('csv_codgest_uscite', csv_codgest_uscite, '*CODGEST_USCITE*.csv')]
+
+
+def csv_tasks(facts=True):
+    # Step 1: a task for each csv_* collection and, for csv_entrate and csv_uscite, one for each file (year)
+    tasks = [new_task(name, target, (find_sources(pattern)[0],)) for name, target, pattern in ANAGRAFICHE_TASKS]
+    # csv_entrate and csv_uscite are optional with --direct
+    if facts:
+        for kind, target in (('ENTRATE', csv_entrate), ('USCITE', csv_uscite)):
+            name = 'csv_' + kind.lower()
+            tasks.append(new_task(name + '/drop', target))
+            # the years are chosen by fact_files()
+            tasks += [new_task(name + '/' + path, csv_facts, (name, path), [name + '/drop'])
+                      for path in fact_files(kind)]
+            tasks.append(new_task(name + '/publish', publish, (name,), [name]))
+    return tasks
+
+
+def mdb_tasks():
+    # Step 2: mdb_enti and mdb_codgest_*, then mdb_entrate and mdb_uscite
+    # from the files (--direct) or from workers partitions of csv_entrate and csv_uscite
+    tasks = [new_task('mdb_enti', build_enti, (),
+                      ['csv_enti', 'csv_sottocomparti', 'csv_comparti', 'csv_regprov', 'csv_comuni']),
+             new_task('mdb_codgest_entrate', build_codgest, ('entrate',), ['csv_codgest_entrate']),
+             new_task('mdb_codgest_uscite', build_codgest, ('uscite',), ['csv_codgest_uscite'])]
+
+    for kind, helper in (('entrate', creating_entrate_mdb_helper), ('uscite', creating_uscite_mdb_helper)):
+        name = 'mdb_' + kind
+        tasks.append(new_task(name + '/prepare', prepare_fact_key, (name,)))
+        deps = [name + '/prepare', 'mdb_enti', 'mdb_codgest_' + kind]
+        if direct or engine == 'pandas':
+            # rows never go through csv_entrate/csv_uscite
+            target = pandas_facts_mdb if engine == 'pandas' else stream_facts_mdb
+            tasks += [new_task(name + '/' + path, target, (kind, path), deps)
+                      for path in fact_files(kind.upper())]
+        elif engine == 'server':
+            # one pipeline, mongod parallelizes the $lookup of the two kinds
+            tasks.append(new_task(name + '/server', server_mdb, (kind,), deps + ['csv_' + kind]))
+        else:
+            # the ranges of csv_<kind> are computed once, for all the helpers
+            tasks.append(new_task(name + '/partition', partition_by_id, (kind, workers), ['csv_' + kind]))
+            tasks += [new_task('%s/%d' % (name, part), helper, (part,), deps + [name + '/partition'])
+                      for part in range(workers)]
+        # after all the loads of name: mdb_*_mensili read it in FACT_KEY order
+        tasks.append(new_task(name + '/indexes', build_indexes, (name,), [name]))
+    return tasks
+
+
+def timeseries_tasks():
+    # Step 3
+    if engine == 'server':
+        return [new_task('mdb_%s_mensili' % kind, server_ts, (kind,), ['mdb_' + kind])
+                for kind in ('entrate', 'uscite')]
+    return [new_task('mdb_entrate_mensili', entrate_ts, (), ['mdb_entrate']),
+            new_task('mdb_uscite_mensili', uscite_ts, (), ['mdb_uscite'])]
+
+
+def rollup_tasks(rollup_years):
+    # Step 4
+    return [new_task('mdb_%s_rollup' % kind, rollup, (kind, rollup_years), ['mdb_%s_mensili' % kind])
+            for kind in ('entrate', 'uscite')]
+
+
+def export_tasks():
+    # --export: a task for each ENTRATE/USCITE file, joined with mdb_enti and mdb_codgest_* as mdb_entrate/uscite
+    if export_dir is None:
+        return []
+    return [new_task('export_%s/%s' % (kind, path), export_facts, (kind, path), ['mdb_enti', 'mdb_codgest_' + kind])
+            for kind in ('entrate', 'uscite') for path in fact_files(kind.upper())]
+
+
+def staged_facts():
+    # True if step 2 joins csv_entrate/csv_uscite, False if it reads the fact files (--direct, --engine=pandas)
+    return not direct and engine != 'pandas'
+
+
+def table_to_collection(download=True, facts=True):
+    prepare_csvfiles(download)
 
     print('*** CREATING CSV COLLECTIONS *** [Step 1/3]')
-    # Scrivo in ogni collezione del db siope con un processo per collezione
-    p1 = mp.Process(target=csv_enti, args=(glob.glob('*ENTI_SIOPE*.csv')[0],))
-    p2 = mp.Process(target=csv_comparti, args=(glob.glob('*_COMPARTI*.csv')[0],))
-    p3 = mp.Process(target=csv_sottocomparti, args=(glob.glob('*SOTTOCOMPARTI*.csv')[0],))
-    p4 = mp.Process(target=csv_comuni, args=(glob.glob('*COMUNI*.csv')[0],))
-    p5 = mp.Process(target=csv_regprov, args=(glob.glob('*REG_PROV*.csv')[0],))
-    p6 = mp.Process(target=csv_codgest_entrate, args=(glob.glob('*CODGEST_ENTRATE*.csv')[0],))
-    p7 = mp.Process(target=csv_codgest_uscite, args=(glob.glob('*CODGEST_USCITE*.csv')[0],))
-    # ---------------------------------------------------------------------------------------
-    # Invert the comments of the following lines to populate your database with all the years
-    # ---------------------------------------------------------------------------------------
-    # p8 = mp.Process(target=csv_entrate,args=(glob.glob('ENTRATE.csv')[0],))
-    p8 = mp.Process(target=csv_entrate, args=(glob.glob('ENTRATE_2016*.csv')[0],))
-    # p9 = mp.Process(target=csv_uscite,args=(glob.glob('USCITE.csv')[0],))
-    p9 = mp.Process(target=csv_uscite, args=(glob.glob('USCITE_2016*.csv')[0],))
-
-    p1.start()
-    p2.start()
-    p3.start()
-    p4.start()
-    p5.start()
-    p6.start()
-    p7.start()
-    p8.start()
-    p9.start()
-    p1.join()
-    p2.join()
-    p3.join()
-    p4.join()
-    p5.join()
-    p6.join()
-    p7.join()
-    p8.join()
-    p9.join()
+    run_tasks(csv_tasks(facts))
 
 
 def build_collection_mdb():
     print('*** CREATING MDB COLLECTIONS *** [Step 2/3]')
-    db = get_connection()
+    run_tasks(mdb_tasks())
+
+
+def load_all(download=True, facts=True, rollup_years=None):
+    # Steps 1-3 and, with rollup_years, step 4 without barriers between them:
+    # e.g. mdb_enti is built while csv_entrate and csv_uscite are still loading
+    prepare_csvfiles(download)
+
+    print('*** CREATING CSV, MDB AND TIME SERIES COLLECTIONS *** [Steps 1-3]')
+    tasks = csv_tasks(facts) + mdb_tasks() + timeseries_tasks() + export_tasks() + manifest_tasks()
+    if rollup_years:
+        tasks += rollup_tasks(rollup_years)
+    run_tasks(tasks)
+
+
+def manifest_tasks():
+    # The fingerprints of the files of a full load, recorded when the collections built from them are complete:
+    # the next --incremental replaces only what changed since
+    tasks = [new_task('manifest/anagrafiche', record_manifest, (None,),
+                      ['mdb_enti', 'mdb_codgest_entrate', 'mdb_codgest_uscite'])]
+    for kind in ('entrate', 'uscite'):
+        tasks += [new_task('manifest/' + path, record_manifest, (path,), ['mdb_%s_mensili' % kind])
+                  for path in fact_files(kind.upper())]
+    return tasks
+
+
+def build_dimensions(anagrafiche_id):
+    # --incremental with changed anagrafiche: mdb_enti, mdb_codgest_entrate and mdb_codgest_uscite from scratch
+    run_tasks([new_task('mdb_enti/drop', reset_dimensions, (anagrafiche_id,)),
+               new_task('mdb_enti', build_enti, (), ['mdb_enti/drop']),
+               new_task('mdb_codgest_entrate', build_codgest, ('entrate',)),
+               new_task('mdb_codgest_uscite', build_codgest, ('uscite',))])
+
+
+def load_anagrafiche(db):
+    # sottocomparti, comparti, province and comuni joined with csv_enti, each one read with a single query.
+    # Values are tuples of (mdb_enti field, value) pairs, as in load_enti()
+    sottocomparti = dict((sc['SOTTOCOMPARTO'], (('DESCR_SOTTOCOMPARTO', sc['DESCRIZIONE']),
+                                                ('COD_COMPARTO', sc['COD_COMPARTO'])))
+                         for sc in db.csv_sottocomparti.find())
+    comparti = dict((c['COD_COMPARTO'], (('DESCR_COMPARTO', c['DESCRIZIONE_COMPARTO']),))
+                    for c in db.csv_comparti.find())
+    province = dict((p['COD_PROVINCIA'], (('DESCR_PROVINCIA', p['DESCRIZIONE_PROVINCIA']),
+                                          ('DESCR_REGIONE', p['DESCRIZIONE REGIONE']),
+                                          ('COD_REGIONE', p['COD_REGIONE']),
+                                          ('RIPART_GEO', p['RIPART_GEO'])))
+                    for p in db.csv_regprov.find())
+    comuni = dict(((c['COD_COMUNE'], c['COD_PROVINCIA']), (('DESCR_COMUNE', c['DESCR_COMUNE']),))
+                  for c in db.csv_comuni.find())
+    return sottocomparti, comparti, province, comuni
+
+
+# fields of mdb_enti left empty when the provincia or the comune of an ente is missing
+PROVINCIA_FIELDS = (('DESCR_PROVINCIA', None), ('DESCR_REGIONE', None), ('COD_REGIONE', None), ('RIPART_GEO', None))
+COMUNE_FIELDS = (('DESCR_COMUNE', None),)
+
+
+def enrich_ente(ente, anagrafiche):
+    # Returns the mdb_enti document of a csv_enti row and the list of its references not found.
+    # The document is None without sottocomparto or comparto: facts are joined by COD_COMPARTO
+    sottocomparti, comparti, province, comuni = anagrafiche
+    ente_r = {'COD_ENTE': ente['COD_ENTE'],
+              'DATA_INC_SIOPE': ente['DATA_INC_SIOPE'],
+              'DATA_ESC_SIOPE': ente['DATA_ESC_SIOPE'],
+              'COD_FISCALE': ente['COD_FISCALE'],
+              'DESCR_ENTE': ente['DESCR_ENTE'],
+              'COD_COMUNE': ente['COD_COMUNE'],
+              'COD_PROVINCIA': ente['COD_PROVINCIA'],
+              'NUM_ABITANTI': ente['NUM_ABITANTI'],
+              'COD_SOTTOCOMPARTO': ente['SOTTOCOMPARTO_SIOPE']}
+
+    sc = sottocomparti.get(ente_r['COD_SOTTOCOMPARTO'])
+    if sc is None:
+        return None, ['sottocomparto %s' % ente_r['COD_SOTTOCOMPARTO']]
+    ente_r.update(sc)
+
+    c = comparti.get(ente_r['COD_COMPARTO'])
+    if c is None:
+        return None, ['comparto %s' % ente_r['COD_COMPARTO']]
+    ente_r.update(c)
+
+    missing = []
+    p = province.get(ente_r['COD_PROVINCIA'])
+    if p is None:
+        missing.append('provincia %s' % ente_r['COD_PROVINCIA'])
+    ente_r.update(p or PROVINCIA_FIELDS)
+
+    c = comuni.get((ente_r['COD_COMUNE'], ente_r['COD_PROVINCIA']))
+    if c is None:
+        missing.append('comune %s/%s' % (ente_r['COD_COMUNE'], ente_r['COD_PROVINCIA']))
+    ente_r.update(c or COMUNE_FIELDS)
+
+    return ente_r, missing
+
+
+# missing references printed by build_enti(), the others are only counted
+MAX_WARNINGS = 20
+
+
+def enti_docs(enti, anagrafiche, stored, stats):
+    # mdb_enti documents of the csv_enti rows whose COD_ENTE is not in stored
+    warnings = 0
+    for ente in enti:
+
+        if ente['COD_ENTE'] in stored:
+            stats['duplicates'] += 1
+            continue
 
-    db.csv_sottocomparti.create_index([('SOTTOCOMPARTO', pymongo.ASCENDING)])
-    db.csv_comparti.create_index([('COD_COMPARTO', pymongo.ASCENDING)])
-    db.csv_regprov.create_index([('COD_PROVINCIA', pymongo.ASCENDING)])
-    db.csv_comuni.create_index([('COD_COMUNE', pymongo.ASCENDING), ('COD_PROVINCIA', pymongo.ASCENDING)])
+        ente_r, missing = enrich_ente(ente, anagrafiche)
+        if missing:
+            stats['reference_miss'] += 1
+            if warnings < MAX_WARNINGS:
+                print('Warning: ente %s, %s not found%s' % (ente['COD_ENTE'], ', '.join(missing),
+                                                            '' if ente_r is not None else ': dropped'))
+            warnings += 1
+        if ente_r is None:
+            stats['ente_miss'] += 1
+            continue
+
+        stored.add(ente_r['COD_ENTE'])
+        yield ente_r
 
+
+def build_enti():
+    # One pass over csv_enti joined in memory with the anagrafiche:
+    # enti already in mdb_enti (by COD_ENTE) are kept
     print('CREATING mdb_enti')
 
-    enti = db.csv_enti.find()
-    db.mdb_enti.create_index([('COD_ENTE', pymongo.ASCENDING)])
-    bulk = db.mdb_enti.initialize_unordered_bulk_op()
-    i = 0
-    for ente in enti:
+    db = get_connection()
+    stats = new_metrics('mdb_enti')
 
-        if db.mdb_enti.find_one({'COD_ENTE': ente['COD_ENTE']}) is not None:
-            continue
+    anagrafiche = load_anagrafiche(db)
+    stored = set(ente['COD_ENTE'] for ente in db.mdb_enti.find({}, {'_id': False, 'COD_ENTE': True}))
 
-        ente_r = {'COD_ENTE': ente['COD_ENTE'],
-                  'DATA_INC_SIOPE': ente['DATA_INC_SIOPE'],
-                  'DATA_ESC_SIOPE': ente['DATA_ESC_SIOPE'],
-                  'COD_FISCALE': ente['COD_FISCALE'],
-                  'DESCR_ENTE': ente['DESCR_ENTE'],
-                  'COD_COMUNE': ente['COD_COMUNE'],
-                  'COD_PROVINCIA': ente['COD_PROVINCIA'],
-                  'NUM_ABITANTI': int(ente['NUM_ABITANTI'] or 0),
-                  'COD_SOTTOCOMPARTO': ente['SOTTOCOMPARTO_SIOPE']}
+    write_documents(db.mdb_enti, enti_docs(counted(db.csv_enti.find(), stats), anagrafiche, stored, stats), stats)
+    build_indexes('mdb_enti')
 
-        sc = db.csv_sottocomparti.find_one({'SOTTOCOMPARTO': ente_r['COD_SOTTOCOMPARTO']})
+    if stats['reference_miss']:
+        print('mdb_enti: %d enti with missing references, %d dropped (sottocomparto or comparto not found)'
+              % (stats['reference_miss'], stats['ente_miss']))
+    finish_metrics(stats)
 
-        ente_r.update({'DESCR_SOTTOCOMPARTO': sc['DESCRIZIONE'],
-                       'COD_COMPARTO': sc['COD_COMPARTO']})
 
-        c = db.csv_comparti.find_one({'COD_COMPARTO': ente_r['COD_COMPARTO']})
+def build_codgest(kind):
+    # kind is 'entrate' or 'uscite'
+    print('CREATING mdb_codgest_%s' % kind)
 
-        ente_r.update({'DESCR_COMPARTO': c['DESCRIZIONE_COMPARTO']})
+    db = get_connection()
+    name = 'mdb_codgest_' + kind
+    collection = db[build_name(name)]
+
+    collection.drop()
+    stats = new_metrics(name)
+
+    # DESCRIZIONE_CGE or DESCRIZIONE_CGU
+    descrizione = 'DESCRIZIONE_CG' + kind[0].upper()
+    codgest = []
+    for el in counted(db['csv_codgest_' + kind].find(), stats):
+        el['DESCRIZIONE_CG'] = el.pop(descrizione)
+        codgest.append(el)
+    write_documents(collection, codgest, stats)
+    publish(name)
+    finish_metrics(stats)
+
+
+def cache_entries(collection):
+    # With --max-memory, the number of documents of a dimension collection that fit half of the DIMENSION_SHARE
+    # of a process (mdb_enti and mdb_codgest_* are held at the same time). None if all of them fit
+    memory = process_memory()
+    sample = collection.find_one({}, {'_id': False}) if memory is not None else None
+    if sample is None:
+        return None
+    entries = max(1, int(memory * DIMENSION_SHARE / 2 // (len(bson.BSON.encode(sample)) * MEMORY_PER_BSON_BYTE)))
+    return entries if collection.estimated_document_count() > entries else None
+
+
+class DimensionCache(object):
+    # Used by join_fact() as the dict of load_enti() or load_codgest() when the collection does not fit
+    # --max-memory: it holds the entries most recently used, a key not held is looked up in mongod
+    # (INDEXES covers it). Keys not found are held too, as None
+    def __init__(self, lookup, entries):
+        self.lookup = lookup
+        self.entries = entries
+        self.held = collections.OrderedDict()
+
+    def get(self, key):
+        if key in self.held:
+            value = self.held.pop(key)
+        else:
+            value = self.lookup(key)
+            if len(self.held) >= self.entries:
+                self.held.popitem(last=False)
+        self.held[key] = value
+        return value
+
+
+def last_document(collection, query):
+    # The document inserted last matching query: the one a dict of load_enti() or load_codgest() keeps
+    for doc in collection.find(query, {'_id': False}).sort('_id', pymongo.DESCENDING).limit(1):
+        return doc
+    return None
+
+
+def ente_entry(ente):
+    # tuples are about half the size of dicts and dict.update() accepts them
+    return ente['COD_COMPARTO'], tuple(ente.items())
+
+
+def codgest_entry(cg):
+    cg.pop('COD_CATEG')
+    return tuple(cg.items())
+
+
+def enti_dict(enti):
+    # COD_ENTE -> (COD_COMPARTO, ente fields as a tuple of pairs) of mdb_enti documents, the last one of a key wins
+    result = {}
+    for ente in enti:
+        result[ente['COD_ENTE']] = ente_entry(ente)
+    return result
 
-        p = db.csv_regprov.find_one({'COD_PROVINCIA': ente_r['COD_PROVINCIA']})
 
-        ente_r.update({'DESCR_PROVINCIA': p['DESCRIZIONE_PROVINCIA'],
-                       'DESCR_REGIONE': p['DESCRIZIONE REGIONE'],
-                       'COD_REGIONE': p['COD_REGIONE'],
-                       'RIPART_GEO': p['RIPART_GEO']})
+def codgest_dict(codgest):
+    # (COD_GEST, COD_CATEG) -> codgest fields (without COD_CATEG) of mdb_codgest_* documents, the last one wins
+    result = {}
+    for cg in codgest:
+        key = (cg['COD_GEST'], cg['COD_CATEG'])
+        result[key] = codgest_entry(cg)
+    return result
 
-        c = db.csv_comuni.find_one({'COD_COMUNE': ente_r['COD_COMUNE'], 'COD_PROVINCIA': ente_r['COD_PROVINCIA']})
 
-        ente_r.update({'DESCR_COMUNE': c['DESCR_COMUNE']})
+def load_enti(db):
+    # COD_ENTE -> (COD_COMPARTO, ente fields as a tuple of pairs)
+    entries = cache_entries(db.mdb_enti)
+    if entries is not None:
+        print('mdb_enti does not fit --max-memory: %d enti held at once' % entries)
 
-        bulk.insert(ente_r)
-        i += 1
+        def lookup(cod_ente):
+            ente = last_document(db.mdb_enti, {'COD_ENTE': cod_ente})
+            return ente_entry(ente) if ente is not None else None
+        return DimensionCache(lookup, entries)
+    return enti_dict(db.mdb_enti.find({}, {'_id': False}))
 
-        if i % 50000 == 0:
-            bulk.execute()
-            bulk = db.mdb_enti.initialize_unordered_bulk_op()
 
-    try:
-        bulk.execute()
-    except pymongo.errors.InvalidOperation:
-        pass
+def load_codgest(collection):
+    # (COD_GEST, COD_CATEG) -> codgest fields (without COD_CATEG) as a tuple of pairs
+    entries = cache_entries(collection)
+    if entries is not None:
+        print('%s does not fit --max-memory: %d codici gestionali held at once' % (collection.name, entries))
 
-    print('CREATING mdb_codgest_entrate')
+        def lookup(key):
+            cg = last_document(collection, {'COD_GEST': key[0], 'COD_CATEG': key[1]})
+            return codgest_entry(cg) if cg is not None else None
+        return DimensionCache(lookup, entries)
+    return codgest_dict(collection.find({}, {'_id': False}))
 
-    db.mdb_codgest_entrate.drop()
-    db.mdb_codgest_entrate.create_index([('COD_GEST', pymongo.ASCENDING), ('COD_CATEG', pymongo.ASCENDING)])
-    csv_codgest_entrate = db.csv_codgest_entrate.find()
-    bulk = db.mdb_codgest_entrate.initialize_unordered_bulk_op()
 
-    for el in csv_codgest_entrate:
-        el['DESCRIZIONE_CG'] = el.pop('DESCRIZIONE_CGE')
-        bulk.insert(el)
-    bulk.execute()
+def join_fact(row, enti, codgest, stats):
+    # Converts a typed csv_entrate/csv_uscite row into a mdb_entrate/mdb_uscite document
+    # enriched with ente and codgest fields. Returns None if the row has to be dropped.
+    ente = enti.get(row['COD_ENTE'])
+    if ente is None:
+        stats['ente_miss'] += 1
+        return None
 
-    print('CREATING mdb_codgest_uscite')
+    cg = codgest.get((row['CODICE_GESTIONALE'], ente[0]))
+    if cg is None:
+        stats['codgest_miss'] += 1
+        return None
 
-    db.mdb_codgest_uscite.drop()
-    db.mdb_codgest_uscite.create_index([('COD_GEST', pymongo.ASCENDING), ('COD_CATEG', pymongo.ASCENDING)])
-    csv_codgest_uscite = db.csv_codgest_uscite.find()
-    bulk = db.mdb_codgest_uscite.initialize_unordered_bulk_op()
+    row['COD_GEST'] = row.pop('CODICE_GESTIONALE')
+    row['IMPORTO'] = row.pop('IMP_USCITE_ATT')
 
-    for el in csv_codgest_uscite:
-        el['DESCRIZIONE_CG'] = el.pop('DESCRIZIONE_CGU')
-        bulk.insert(el)
-    bulk.execute()
+    row.update(ente[1])
+    row.update(cg)
+    row['_id'] = fact_id(row)
+    stats['joined'] += 1
+    return row
 
-    p1 = mp.Process(target=creating_entrate_mdb)
-    p2 = mp.Process(target=creating_uscite_mdb)
-    p1.start()
-    p2.start()
-    p1.join()
-    p2.join()
 
+def fact_id(fact):
+    # Deterministic _id of a mdb_entrate/mdb_uscite document, from its natural key (FACT_KEY):
+    # a row loaded twice, by a re-run or by overlapping workers, is rejected as a duplicate
+    return '%s/%s/%s/%s' % (fact['ANNO'], fact['PERIODO'], fact['COD_ENTE'], fact['COD_GEST'])
 
-def creating_entrate_mdb():
-    print('CREATING mdb_entrate')
 
+def create_fact_key(collection):
+    # Creates the unique index on FACT_KEY, removing first the duplicate rows that prevent it:
+    # loaded while the index was deferred by prepare_fact_key() or by older versions of this script
+    try:
+        collection.create_index(FACT_KEY, unique=True)
+    except pymongo.errors.OperationFailure as e:
+        if e.code != 11000:
+            raise
+        print('%s: %d duplicate rows removed' % (collection.name, drop_duplicates(collection)))
+        collection.create_index(FACT_KEY, unique=True)
+
+
+def ensure_fact_key(name):
+    # The unique index on the natural key rejects the rows stored with ObjectId _ids by older versions
+    # of this script, fact_id() does the same for the others
+    collection = get_connection()[name]
+    try:
+        create_fact_key(collection)
+    except pymongo.errors.OperationFailure as e:
+        # 85 IndexOptionsConflict, 86 IndexKeySpecsConflict:
+        # index created without the unique option by older versions of this script
+        if e.code not in (85, 86):
+            raise
+        collection.drop_index(FACT_KEY)
+        create_fact_key(collection)
+
+
+def prepare_fact_key(name):
+    # The unique index on FACT_KEY is maintained during the load only if $merge (--engine=server)
+    # needs it or if the collection has documents stored by older versions (the oldest one has an ObjectId):
+    # fact_id() rejects the rows already stored. Otherwise it is created after the load by build_indexes()
+    oldest = get_connection()[name].find_one({}, {'_id': True})
+    if engine == 'server' or (oldest is not None and isinstance(oldest['_id'], bson.ObjectId)):
+        ensure_fact_key(name)
+
+
+def oldest_first(_id):
+    # Sort key of the _ids of a FACT_KEY: the ObjectIds of older versions of this script in insertion order,
+    # then the fact_id() (one at most). mongod sorts strings before ObjectIds
+    return (0, _id) if isinstance(_id, bson.ObjectId) else (1, _id)
+
+
+def drop_duplicates(collection):
+    # Keeps the oldest document of each FACT_KEY, as the unique index does. Returns the documents removed.
+    # They are deleted while the groups are read, 10000 at a time: a whole load may be duplicated
+    group = {'_id': dict((field, '$' + field) for field, direction in FACT_KEY),
+             'IDS': {'$push': '$_id'}, 'N': {'$sum': 1}}
+    removed = 0
+    duplicates = []
+    for doc in collection.aggregate([{'$group': group}, {'$match': {'N': {'$gt': 1}}}], allowDiskUse=True):
+        duplicates += sorted(doc['IDS'], key=oldest_first)[1:]
+        if len(duplicates) >= 10000:
+            collection.delete_many({'_id': {'$in': duplicates}})
+            removed += len(duplicates)
+            duplicates = []
+    if duplicates:
+        collection.delete_many({'_id': {'$in': duplicates}})
+    return removed + len(duplicates)
+
+
+def partition_bounds(collection, n):
+    # The _ids splitting the collection in (at most) n disjoint ranges of about the same size,
+    # read in one pass over the _id index: the _id at each position total * k // n, k = 1 .. n - 1
+    total = collection.estimated_document_count()
+    positions = set(total * k // n for k in range(1, n))
+    bounds = []
+    if not positions:
+        return bounds
+    last = max(positions)
+    for position, doc in enumerate(collection.find({}, {'_id': True}).sort('_id', pymongo.ASCENDING)):
+        if position in positions:
+            bounds.append(doc['_id'])
+        if position == last:
+            break
+    return bounds
+
+
+def partition_by_id(kind, parts):
+    # Task mdb_<kind>/partition: splits csv_<kind> in the ranges joined by the parts helpers of mdb_<kind>
+    # and stores their bounds in the journal collection, so the _id index is scanned once and a resumed run
+    # reads the same ranges
+    db = get_connection()
+    doc = {'_id': 'partition/mdb_' + kind, 'BOUNDS': partition_bounds(db['csv_' + kind], parts)}
+    db.journal.replace_one({'_id': doc['_id']}, doc, upsert=True)
+
+
+def partition_queries(kind):
+    # One query for each _id range stored by partition_by_id()
+    bounds = get_connection().journal.find_one({'_id': 'partition/mdb_' + kind})['BOUNDS']
+    queries = []
+    lower = None
+    for upper in bounds + [None]:
+        id_range = {}
+        if lower is not None:
+            id_range['$gte'] = lower
+        if upper is not None:
+            id_range['$lt'] = upper
+        queries.append({'_id': id_range} if id_range else {})
+        lower = upper
+    return queries
+
+
+def creating_entrate_mdb_helper(part):
+    # Joins the part-th _id range of csv_entrate (partition_by_id())
     db = get_connection()
+    queries = partition_queries('entrate')
+    if part >= len(queries):
+        # fewer documents than parts
+        return
+    print('CREATING mdb_entrate (%d/%d)' % (part + 1, len(queries)))
+    cursor = db.csv_entrate.find(queries[part]).sort('_id', pymongo.ASCENDING)
 
-    db.mdb_entrate.create_index([('COD_ENTE', pymongo.ASCENDING), ('ANNO', pymongo.ASCENDING),
-                                 ('PERIODO', pymongo.ASCENDING), ('COD_GEST', pymongo.ASCENDING)])
+    enti = load_enti(db)
+    codgest = load_codgest(db.mdb_codgest_entrate)
+    stats = new_metrics('mdb_entrate')
 
-    num_documents_csv_entrate = db.csv_entrate.count()
-    index = num_documents_csv_entrate // 4
+    rows = (expand_keys(e) for e in counted(resumed(cursor, stats), stats))
+    write_documents(db.mdb_entrate, join_facts(rows, enti, codgest, stats), stats)
 
-    entrateA = mp.Process(target=creating_entrate_mdb_helper, args=(0, index))
-    entrateB = mp.Process(target=creating_entrate_mdb_helper, args=(index, index*2))
-    entrateC = mp.Process(target=creating_entrate_mdb_helper, args=(index*2, index*3))
-    entrateD = mp.Process(target=creating_entrate_mdb_helper, args=(index*3, None))
-    entrateA.start()
-    entrateB.start()
-    entrateC.start()
-    entrateD.start()
-    entrateA.join()
-    entrateB.join()
-    entrateC.join()
-    entrateD.join()
+    finish_metrics(stats)
 
 
-def creating_entrate_mdb_helper(skip, limit):
+def creating_uscite_mdb_helper(part):
+    # Joins the part-th _id range of csv_uscite (partition_by_id())
     db = get_connection()
-    if limit is not None:
-        cursor = db.csv_entrate.find().limit(limit)
-    else:
-        cursor = db.csv_entrate.find().skip(skip)
-
-    bulk = db.mdb_entrate.initialize_unordered_bulk_op()
+    queries = partition_queries('uscite')
+    if part >= len(queries):
+        # fewer documents than parts
+        return
+    print('CREATING mdb_uscite (%d/%d)' % (part + 1, len(queries)))
+    cursor = db.csv_uscite.find(queries[part]).sort('_id', pymongo.ASCENDING)
 
-    i = 0
-    for e in cursor:
+    enti = load_enti(db)
+    codgest = load_codgest(db.mdb_codgest_uscite)
+    stats = new_metrics('mdb_uscite')
 
-        result = db.mdb_entrate.find_one(
-            {'COD_ENTE': e['COD_ENTE'], 'ANNO': int(e['ANNO'] or 0), 'PERIODO': int(e['PERIODO'] or 0),
-             'COD_GEST': e['CODICE_GESTIONALE']})
-        if result is not None:
-            continue
+    rows = (expand_keys(u) for u in counted(resumed(cursor, stats), stats))
+    write_documents(db.mdb_uscite, join_facts(rows, enti, codgest, stats), stats)
 
-        ente = db.mdb_enti.find_one({'COD_ENTE': e['COD_ENTE']})
-        cg = db.mdb_codgest_entrate.find_one({'COD_GEST': e['CODICE_GESTIONALE'], 'COD_CATEG': ente['COD_COMPARTO']})
-        if cg is None:
-            continue
+    finish_metrics(stats)
 
-        del ente['_id']
-        del cg['_id']
-        del cg['COD_CATEG']
 
-        ente.update(cg)
+def read_facts(path):
+    return typed_rows(read_rows([path], FACT_FIELDNAMES), FACT_FIELDNAMES)
 
-        e['COD_GEST'] = e.pop('CODICE_GESTIONALE')
-        e['IMPORTO'] = int(e.pop('IMP_USCITE_ATT') or 0)
-        e['ANNO'] = int(e['ANNO'] or 0)
-        e['PERIODO'] = int(e['PERIODO'] or 0)
 
-        e.update(ente)
+def join_facts(rows, enti, codgest, stats):
+    for row in rows:
+        if join_fact(row, enti, codgest, stats) is not None:
+            yield row
 
-        bulk.insert(e)
-        i += 1
 
-        if i % 50000 == 0:
-            bulk.execute()
-            bulk = db.mdb_entrate.initialize_unordered_bulk_op()
+def period_of(row):
+    # (ANNO, PERIODO) of a typed csv row
+    return row['ANNO'], row['PERIODO']
 
-    try:
-        bulk.execute()
-    except pymongo.errors.InvalidOperation:
-        pass
 
+def select_periods(rows, periods):
+    for row in rows:
+        if period_of(row) in periods:
+            yield row
 
-def creating_uscite_mdb():
-    print('CREATING mdb_uscite')
 
+def stream_facts_mdb(kind, path, periods=None):
+    # kind is 'entrate' or 'uscite'
+    # csv rows are converted, joined and inserted while the file is read:
+    # memory holds at most one batch of documents (two with --write-thread).
+    # If periods is a set of (ANNO, PERIODO) only the rows of these periods are loaded
     db = get_connection()
+    collection = db['mdb_' + kind]
+
+    enti = load_enti(db)
+    codgest = load_codgest(db['mdb_codgest_' + kind])
+    stats = new_metrics('mdb_' + kind, path)
+
+    if periods is not None:
+        rows = select_periods(counted(read_facts(path), stats), periods)
+    else:
+        # not a refresh, which deletes its periods again
+        rows = counted(resumed(read_facts(path), stats), stats)
+
+    write_documents(collection, join_facts(rows, enti, codgest, stats), stats)
+
+    finish_metrics(stats)
+
+
+def export_schema(pa):
+    # pa is the pyarrow module, imported only with --export
+    types = []
+    for field in EXPORT_COLUMNS:
+        if field in EXPORT_INTS:
+            types.append((field, pa.int64()))
+        elif field in EXPORT_DATES:
+            types.append((field, pa.timestamp('ms')))
+        else:
+            types.append((field, pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(types)
 
-    db.mdb_uscite.create_index([('COD_ENTE', pymongo.ASCENDING), ('ANNO', pymongo.ASCENDING),
-                                ('PERIODO', pymongo.ASCENDING), ('COD_GEST', pymongo.ASCENDING)])
 
-    num_documents_csv_uscite = db.csv_uscite.count()
-    index = num_documents_csv_uscite // 4
+def export_value(field, value):
+    # to_date() keeps the dates in unknown formats as strings: they are exported as null
+    if field in EXPORT_DATES and not isinstance(value, datetime.datetime):
+        return None
+    return value
 
-    usciteA = mp.Process(target=creating_uscite_mdb_helper, args=(0, index))
-    usciteB = mp.Process(target=creating_uscite_mdb_helper, args=(index, index*2))
-    usciteC = mp.Process(target=creating_uscite_mdb_helper, args=(index*2, index*3))
-    usciteD = mp.Process(target=creating_uscite_mdb_helper, args=(index*3, None))
-    usciteA.start()
-    usciteB.start()
-    usciteC.start()
-    usciteD.start()
-    usciteA.join()
-    usciteB.join()
-    usciteC.join()
-    usciteD.join()
 
+def export_facts(kind, path):
+    # --export: the rows of an ENTRATE/USCITE csv file, converted and joined as in stream_facts_mdb(),
+    # written in <export_dir>/mdb_<kind>/ANNO=<year>/<file>.parquet with a row group every rows_in_memory() rows.
+    # A file is written under a hidden name and renamed when complete: readers never see it half written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
-def creating_uscite_mdb_helper(skip, limit):
     db = get_connection()
-    if limit is not None:
-        cursor = db.csv_uscite.find().limit(limit)
-    else:
-        cursor = db.csv_uscite.find().skip(skip)
+    enti = load_enti(db)
+    codgest = load_codgest(db['mdb_codgest_' + kind])
+    stats = new_metrics('export_' + kind, path)
+
+    schema = export_schema(pa)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # ANNO -> (directory, writer, {column: values of the next row group})
+    years_out = {}
+    # sized on the first row
+    group_rows = None
+
+    def write_row_group(anno):
+        directory, writer, columns = years_out[anno]
+        start = time.time()
+        rows = len(columns['PERIODO'])
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        for values in columns.values():
+            del values[:]
+        record_bulk(stats, time.time() - start, rows)
+
+    for fact in join_facts(counted(read_facts(path), stats), enti, codgest, stats):
+        if group_rows is None:
+            group_rows = rows_in_memory(len(bson.BSON.encode(fact)))
+        anno = fact['ANNO']
+        if anno not in years_out:
+            directory = os.path.join(export_dir, 'mdb_' + kind, 'ANNO=%d' % anno)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            writer = pq.ParquetWriter(os.path.join(directory, '.%s.parquet' % stem), schema)
+            years_out[anno] = (directory, writer, dict((field, []) for field in EXPORT_COLUMNS))
+        columns = years_out[anno][2]
+        for field in EXPORT_COLUMNS:
+            columns[field].append(export_value(field, fact.get(field)))
+        if len(columns['PERIODO']) >= group_rows:
+            write_row_group(anno)
+
+    for anno in sorted(years_out):
+        directory, writer, columns = years_out[anno]
+        if columns['PERIODO']:
+            write_row_group(anno)
+        writer.close()
+        target = os.path.join(directory, '%s.parquet' % stem)
+        if os.path.exists(target):
+            # os.rename() does not replace files on Windows
+            os.remove(target)
+        os.rename(os.path.join(directory, '.%s.parquet' % stem), target)
+
+    finish_metrics(stats)
+
+
+def pandas_facts_mdb(kind, path):
+    # --engine=pandas: as stream_facts_mdb(), but the file is read in chunks of rows_in_memory() rows and each chunk
+    # is parsed, converted and joined at once: read_csv, vectorized int conversion, the ente of each row with a map
+    # and its codgest with a merge, _id with vectorized concatenation. Only the documents are built row by row,
+    # as join_fact() does: the fields of the row updated with the tuples of its ente and codgest
+    import pandas as pd
 
-    bulk = db.mdb_uscite.initialize_unordered_bulk_op()
+    db = get_connection()
+    collection = db['mdb_' + kind]
+    codgest_collection = db['mdb_codgest_' + kind]
+    stats = new_metrics('mdb_' + kind, path)
+
+    # with --max-memory, if mdb_enti or mdb_codgest_<kind> do not fit (cache_entries()),
+    # each chunk reads the enti and the codici gestionali of its rows only
+    by_chunk = cache_entries(db.mdb_enti) is not None or cache_entries(codgest_collection) is not None
+    if by_chunk:
+        print('mdb_%s: mdb_enti and mdb_codgest_%s do not fit --max-memory, they are read for each chunk'
+              % (kind, kind))
+    # a chunk is held as DataFrames and as documents: about twice the BSON of its documents,
+    # the ente and codgest fields and about 100 bytes of fact fields and _id
+    samples = [doc for doc in (db.mdb_enti.find_one({}, {'_id': False}),
+                               codgest_collection.find_one({}, {'_id': False})) if doc is not None]
+    chunk_rows = rows_in_memory(2 * (sum(len(bson.BSON.encode(doc)) for doc in samples) + 100))
+
+    def dimensions(enti, codgest):
+        # the enti, their COD_COMPARTO by COD_ENTE, the codgest tuples and their keys with their position
+        codgest = list(codgest.items())
+        keys = pd.DataFrame([key for key, cg in codgest], columns=['COD_GEST', 'COD_COMPARTO'], dtype=object)
+        keys['CG'] = range(len(codgest))
+        comparti = pd.Series(dict((cod_ente, ente[0]) for cod_ente, ente in enti.items()), dtype=object)
+        return enti, comparti, [cg for key, cg in codgest], keys
+
+    if not by_chunk:
+        tables = dimensions(enti_dict(db.mdb_enti.find({}, {'_id': False})),
+                            codgest_dict(codgest_collection.find({}, {'_id': False})))
+
+    int_fields = [field for field in FACT_FIELDNAMES if FIELD_TYPES.get(field) is to_int]
+
+    def docs():
+        position = resume_position(stats)
+        with open_source(path) as csvfile:
+            # the int fields are parsed by read_csv, empty ones are NaN
+            chunks = pd.read_csv(csvfile, header=None, names=FACT_FIELDNAMES, keep_default_na=False,
+                                 dtype=dict((field, str) for field in FACT_FIELDNAMES if field not in int_fields),
+                                 na_values=dict((field, ['']) for field in int_fields),
+                                 chunksize=chunk_rows)
+            for chunk in chunks:
+                # the index counts the rows of the file without the blank lines, as csv.DictReader and
+                # resumed() do: the rows inserted by the interrupted run are skipped after they are parsed
+                if position:
+                    chunk = chunk[chunk.index >= position].copy()
+                rows = len(chunk)
+                if not rows:
+                    continue
+                stats['read'] += rows
+                # number of the row in the file, the position journaled when its document is inserted
+                chunk['ROW'] = chunk.index + 1
+                for field in int_fields:
+                    # to_int()
+                    chunk[field] = chunk[field].fillna(0).astype('int64')
+                chunk = chunk.fillna('').rename(columns={'CODICE_GESTIONALE': 'COD_GEST',
+                                                         'IMP_USCITE_ATT': 'IMPORTO'})
+
+                if by_chunk:
+                    codes = {'$in': sorted(set(chunk['COD_ENTE'].tolist()))}
+                    enti, comparti, codgest, keys = dimensions(
+                        enti_dict(db.mdb_enti.find({'COD_ENTE': codes}, {'_id': False})),
+                        codgest_dict(codgest_collection.find({'COD_GEST': {'$in': sorted(set(
+                            chunk['COD_GEST'].tolist()))}}, {'_id': False})))
+                else:
+                    enti, comparti, codgest, keys = tables
+
+                chunk['COD_COMPARTO'] = chunk['COD_ENTE'].map(comparti)
+                joined = chunk[chunk['COD_COMPARTO'].notna()]
+                stats['ente_miss'] += rows - len(joined)
+                # a left merge keeps the order of the rows
+                facts = joined.merge(keys, on=['COD_GEST', 'COD_COMPARTO'], how='left')
+                facts = facts[facts['CG'].notna()]
+                stats['codgest_miss'] += len(joined) - len(facts)
+                stats['joined'] += len(facts)
+
+                # fact_id()
+                facts['_id'] = (facts['ANNO'].astype(str) + '/' + facts['PERIODO'].astype(str) + '/' +
+                                facts['COD_ENTE'] + '/' + facts['COD_GEST'])
+                # tolist() gives python values
+                values = [facts[field].tolist() for field in ('COD_ENTE', 'ANNO', 'PERIODO', 'COD_GEST', 'IMPORTO',
+                                                              '_id', 'ROW')]
+                for cod_ente, anno, periodo, cod_gest, importo, _id, row, cg in zip(
+                        *(values + [facts['CG'].astype(int).tolist()])):
+                    if position is not None:
+                        stats['position'] = row
+                    doc = {'COD_ENTE': cod_ente, 'ANNO': anno, 'PERIODO': periodo, 'COD_GEST': cod_gest,
+                           'IMPORTO': importo}
+                    doc.update(enti[cod_ente][1])
+                    doc.update(codgest[cg])
+                    doc['_id'] = _id
+                    yield doc
+                if position is not None:
+                    stats['position'] = int(chunk['ROW'].iloc[-1])
+                print_progress(stats)
+
+    write_documents(collection, docs(), stats)
+
+    finish_metrics(stats)
+
+
+def server_mdb_pipeline(kind):
+    # csv_<kind> joined with mdb_enti and mdb_codgest_<kind> as join_fact() does.
+    # $merge keeps the documents already stored, as the unique index on FACT_KEY does
+    fact = dict((field, '$' + (SHORT_KEYS[field] if short_keys else field)) for field in FACT_FIELDNAMES)
+    document = dict((field, '$ENTE.' + field) for field in ENTE_FIELDS)
+    document.update((field, '$CG.' + field) for field in IMPORTO_FIELDS if field != 'IMPORTO')
+    document.update({'ANNO': True, 'PERIODO': True, 'IMPORTO': True})
+    # fact_id()
+    document['_id'] = {'$concat': [{'$toString': '$ANNO'}, '/', {'$toString': '$PERIODO'}, '/',
+                                   '$COD_ENTE', '/', '$COD_GEST']}
+
+    return [{'$project': {'_id': False, 'COD_ENTE': fact['COD_ENTE'], 'ANNO': fact['ANNO'],
+                          'PERIODO': fact['PERIODO'], 'COD_GEST': fact['CODICE_GESTIONALE'],
+                          'IMPORTO': fact['IMP_USCITE_ATT']}},
+            {'$lookup': {'from': 'mdb_enti', 'localField': 'COD_ENTE', 'foreignField': 'COD_ENTE', 'as': 'ENTE'}},
+            {'$unwind': '$ENTE'},
+            # the index on (COD_GEST, COD_CATEG) is used, the comparto is checked after
+            {'$lookup': {'from': 'mdb_codgest_' + kind, 'localField': 'COD_GEST', 'foreignField': 'COD_GEST',
+                         'as': 'CG'}},
+            {'$unwind': '$CG'},
+            {'$match': {'$expr': {'$eq': ['$CG.COD_CATEG', '$ENTE.COD_COMPARTO']}}},
+            {'$project': document},
+            {'$merge': {'into': 'mdb_' + kind, 'on': [field for field, direction in FACT_KEY],
+                        'whenMatched': 'keepExisting', 'whenNotMatched': 'insert'}}]
+
+
+def server_mdb(kind):
+    # kind is 'entrate' or 'uscite'
+    print('CREATING mdb_%s in mongod' % kind)
+    db = get_connection()
+    collection = db['mdb_' + kind]
+    stats = new_metrics(collection.name, 'server')
 
-    i = 0
-    for u in cursor:
+    stats['read'] = db['csv_' + kind].estimated_document_count()
+    before = collection.estimated_document_count()
+    start = time.time()
+    db['csv_' + kind].aggregate(server_mdb_pipeline(kind), allowDiskUse=True)
+    # rows dropped and already stored are not told apart
+    record_bulk(stats, time.time() - start, collection.estimated_document_count() - before)
 
-        result = db.mdb_uscite.find_one(
-            {'COD_ENTE': u['COD_ENTE'], 'ANNO': int(u['ANNO'] or 0), 'PERIODO': int(u['PERIODO'] or 0),
-             'COD_GEST': u['CODICE_GESTIONALE']})
-        if result is not None:
-            continue
+    finish_metrics(stats)
 
-        ente = db.mdb_enti.find_one({'COD_ENTE': u['COD_ENTE']})
-        cg = db.mdb_codgest_uscite.find_one({'COD_GEST': u['CODICE_GESTIONALE'], 'COD_CATEG': ente['COD_COMPARTO']})
-        if cg is None:
-            continue
 
-        del ente['_id']
-        del cg['_id']
-        del cg['COD_CATEG']
+def server_ts_pipeline(kind):
+    # One document for each COD_ENTE, ANNO, PERIODO with the IMPORTI in COD_GEST order,
+    # as timeseries_docs() on the facts sorted by FACT_KEY
+    group = {'_id': {'$concat': [{'$toString': '$ANNO'}, '/', {'$toString': '$PERIODO'}, '/', '$COD_ENTE']},
+             'IMPORTI': {'$push': dict((field, '$' + field) for field in IMPORTO_FIELDS)}}
+    group.update((field, {'$first': '$' + field}) for field in ENTE_FIELDS + ['ANNO', 'PERIODO'])
 
-        ente.update(cg)
+    totals = {'TOTALE': {'$sum': '$IMPORTI.IMPORTO'},
+              'NUM_IMPORTI': {'$size': '$IMPORTI'},
+              'TOTALI_COD_GEST': {'$arrayToObject': {'$map': {'input': '$IMPORTI',
+                                                              'in': {'k': '$$this.COD_GEST', 'v': '$$this.IMPORTO'}}}}}
 
-        u['COD_GEST'] = u.pop('CODICE_GESTIONALE')
-        u['IMPORTO'] = int(u.pop('IMP_USCITE_ATT') or 0)
-        u['ANNO'] = int(u['ANNO'] or 0)
-        u['PERIODO'] = int(u['PERIODO'] or 0)
+    return [{'$sort': SON(FACT_KEY)},
+            {'$group': group},
+            {'$addFields': totals},
+            {'$out': 'mdb_%s_mensili' % kind}]
 
-        u.update(ente)
 
-        bulk.insert(u)
-        i += 1
+def server_ts(kind):
+    print('CREATING mdb_%s_mensili in mongod' % kind)
+    db = get_connection()
+    collection = db['mdb_%s_mensili' % kind]
+    stats = new_metrics(collection.name, 'server')
 
-        if i % 50000 == 0:
-            bulk.execute()
-            bulk = db.mdb_uscite.initialize_unordered_bulk_op()
+    stats['read'] = db['mdb_' + kind].estimated_document_count()
+    start = time.time()
+    # $out replaces the collection, as entrate_ts() and uscite_ts() do
+    db['mdb_' + kind].aggregate(server_ts_pipeline(kind), allowDiskUse=True)
+    record_bulk(stats, time.time() - start, collection.estimated_document_count())
+    build_indexes(collection.name)
 
-    try:
-        bulk.execute()
-    except pymongo.errors.InvalidOperation:
-        pass
+    finish_metrics(stats)
 
 
 def build_timeseries():
     print('*** CREATING TIME SERIES *** [Step 3/3]')
-
-    p1 = mp.Process(target=entrate_ts)
-    p2 = mp.Process(target=uscite_ts)
-    p1.start()
-    p2.start()
-    p1.join()
-    p2.join()
+    run_tasks(timeseries_tasks())
+
+
+def timeseries_docs(facts):
+    # facts must be sorted by FACT_KEY (the unique index): each group is read at once, so only one group
+    # is held in memory, and its IMPORTI are in COD_GEST order, as in server_ts_pipeline()
+    for key, group in itertools.groupby(facts, key=lambda f: (f['COD_ENTE'], f['ANNO'], f['PERIODO'])):
+        doc = None
+        importi = []
+        for f in group:
+            importi.append(dict((field, f.pop(field)) for field in IMPORTO_FIELDS))
+            if doc is None:
+                doc = f
+
+        doc['_id'] = str(doc['ANNO']) + '/' + str(doc['PERIODO']) + '/' + str(doc['COD_ENTE'])
+        doc['IMPORTI'] = importi
+        # precomputed, the reports that are not split by categoria gestionale do not $unwind IMPORTI.
+        # COD_GEST is unique in a document (FACT_KEY): its subtotal is its IMPORTO
+        doc['TOTALE'] = sum(importo['IMPORTO'] for importo in importi)
+        doc['NUM_IMPORTI'] = len(importi)
+        doc['TOTALI_COD_GEST'] = SON((importo['COD_GEST'], importo['IMPORTO']) for importo in importi)
+        yield doc
+
+
+def insert_timeseries(collection, facts, name=None):
+    # read counts the facts, inserted the documents (metrics of name, DEFAULT: the collection)
+    # documents are much bigger than facts: batches are limited by BATCH_BYTES
+    stats = new_metrics(name or collection.name)
+    write_documents(collection, timeseries_docs(counted(facts, stats)), stats)
+    finish_metrics(stats)
 
 
 def entrate_ts():
@@ -587,31 +1830,11 @@ def entrate_ts():
 
     db = get_connection()
 
-    mdb_entrate = db.mdb_entrate.find()
-    db.mdb_entrate_mensili.drop()
-    db.mdb_entrate_mensili.create_index([('_id', pymongo.ASCENDING)])
-    bulk = db.mdb_entrate_mensili.initialize_unordered_bulk_op()
-    i = 0
-    for e in mdb_entrate:
-
-        e['_id'] = str(e['ANNO']) + '/' + str(e['PERIODO']) + '/' + str(e['COD_ENTE'])
-
-        importo = {'COD_GEST': e.pop('COD_GEST'),
-                   'DESCRIZIONE_CG': e.pop('DESCRIZIONE_CG'),
-                   'IMPORTO': e.pop('IMPORTO'),
-                   'DATA_INIZIO_VALIDITA': e.pop('DATA_INIZIO_VALIDITA'),
-                   'DATA_FINE_VALIDITA': e.pop('DATA_FINE_VALIDITA')
-                   }
-
-        bulk.find({'_id': e['_id']}).upsert().update({'$setOnInsert': e, '$push': {'IMPORTI': importo}})
-        i += 1
-        if i % 50000 == 0:
-            bulk.execute()
-            bulk = db.mdb_entrate_mensili.initialize_unordered_bulk_op()
-    try:
-        bulk.execute()
-    except pymongo.errors.InvalidOperation:
-        pass
+    mdb_entrate = db.mdb_entrate.find().sort(FACT_KEY)
+    mdb_entrate_mensili = db[build_name('mdb_entrate_mensili')]
+    mdb_entrate_mensili.drop()
+    insert_timeseries(mdb_entrate_mensili, mdb_entrate, 'mdb_entrate_mensili')
+    publish('mdb_entrate_mensili')
 
 
 def uscite_ts():
@@ -619,34 +1842,254 @@ def uscite_ts():
 
     db = get_connection()
 
-    mdb_uscite = db.mdb_uscite.find()
-    db.mdb_uscite_mensili.drop()
-    db.mdb_uscite_mensili.create_index([('_id', pymongo.ASCENDING)])
-    bulk = db.mdb_uscite_mensili.initialize_unordered_bulk_op()
-    i = 0
-    for u in mdb_uscite:
-
-        u['_id'] = str(u['ANNO']) + '/' + str(u['PERIODO']) + '/' + str(u['COD_ENTE'])
-
-        importo = {'COD_GEST': u.pop('COD_GEST'),
-                   'DESCRIZIONE_CG': u.pop('DESCRIZIONE_CG'),
-                   'IMPORTO': u.pop('IMPORTO'),
-                   'DATA_INIZIO_VALIDITA': u.pop('DATA_INIZIO_VALIDITA'),
-                   'DATA_FINE_VALIDITA': u.pop('DATA_FINE_VALIDITA')
-                   }
-
-        bulk.find({'_id': u['_id']}).upsert().update({'$setOnInsert': u, '$push': {'IMPORTI': importo}})
-        i += 1
-        if i % 50000 == 0:
-            bulk.execute()
-            bulk = db.mdb_uscite_mensili.initialize_unordered_bulk_op()
-    try:
-        bulk.execute()
-    except pymongo.errors.InvalidOperation:
-        pass
+    mdb_uscite = db.mdb_uscite.find().sort(FACT_KEY)
+    mdb_uscite_mensili = db[build_name('mdb_uscite_mensili')]
+    mdb_uscite_mensili.drop()
+    insert_timeseries(mdb_uscite_mensili, mdb_uscite, 'mdb_uscite_mensili')
+    publish('mdb_uscite_mensili')
+
+
+def build_rollups(rollup_years):
+    print('*** CREATING ROLLUPS *** [Step 4]')
+    run_tasks(rollup_tasks(rollup_years))
+
+
+def rollup(kind, rollup_years):
+    # Replaces the documents of rollup_years in mdb_<kind>_rollup:
+    # one for each year, DIMENSIONE and value of the dimension (VALORE) with the TOTALE of IMPORTI
+    print('CREATING mdb_%s_rollup' % kind)
+
+    db = get_connection()
+    collection = db['mdb_%s_rollup' % kind]
+    stats = new_metrics(collection.name)
+
+    # a single scan of each year computes all the dimensions,
+    # only the fields of IMPORTI (CATEGORIA) need to $unwind it
+    facet = {}
+    for dimension, field in ROLLUP_DIMENSIONS:
+        if field.startswith('$IMPORTI.'):
+            facet[dimension] = [{'$unwind': '$IMPORTI'},
+                                {'$group': {'_id': field, 'TOTALE': {'$sum': '$IMPORTI.IMPORTO'}}}]
+        else:
+            facet[dimension] = [{'$group': {'_id': field, 'TOTALE': {'$sum': MENSILI_TOTALE}}}]
+
+    for year in rollup_years:
+        pipeline = [{'$match': {'ANNO': year}}, {'$facet': facet}]
+        totals = next(db['mdb_%s_mensili' % kind].aggregate(pipeline, allowDiskUse=True))
+
+        docs = [{'ANNO': year, 'DIMENSIONE': dimension, 'VALORE': group['_id'], 'TOTALE': group['TOTALE']}
+                for dimension, field in ROLLUP_DIMENSIONS for group in totals[dimension]]
+        stats['read'] += len(docs)
+        collection.delete_many({'ANNO': year})
+        write_documents(collection, docs, stats)
+
+    build_indexes(collection.name)
+    finish_metrics(stats)
+
+
+def summarize_metrics(name, docs):
+    start = min(doc['start'] for doc in docs)
+    seconds = max(doc['end'] for doc in docs) - start
+    summary = {'COLLECTION': name, 'workers': len(docs), 'seconds': seconds}
+    for field in ('read', 'inserted', 'joined', 'ente_miss', 'codgest_miss', 'duplicates', 'reference_miss',
+                  'bulks', 'bulk_seconds'):
+        summary[field] = sum(doc[field] for doc in docs)
+    summary['bulk_max_seconds'] = max(doc['bulk_max_seconds'] for doc in docs)
+    summary['rows_per_s'] = summary['read'] / max(seconds, 1e-6)
+    summary['WORKERS'] = docs
+    return summary
+
+
+def prometheus_label(value):
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(path, docs):
+    # Text file for the textfile collector of node_exporter, one series for each process
+    metrics = [('siope_rows_read_total', 'counter', 'Rows read', lambda d: d['read']),
+               ('siope_rows_inserted_total', 'counter', 'Documents inserted', lambda d: d['inserted']),
+               ('siope_rows_skipped_total', 'counter', 'Rows dropped (codgest or ente not found) or already stored',
+                skipped),
+               ('siope_bulks_total', 'counter', 'Bulk writes executed', lambda d: d['bulks']),
+               ('siope_bulk_seconds_total', 'counter', 'Time spent in bulk writes', lambda d: d['bulk_seconds']),
+               ('siope_bulk_max_seconds', 'gauge', 'Slowest bulk write', lambda d: d['bulk_max_seconds']),
+               ('siope_duration_seconds', 'gauge', 'Duration of the process', lambda d: d['seconds']),
+               ('siope_rows_per_second', 'gauge', 'Rows read per second', lambda d: d['rows_per_s'])]
+    with open(path, 'w') as f:
+        for name, kind, description, value in metrics:
+            f.write('# HELP %s %s\n# TYPE %s %s\n' % (name, description, name, kind))
+            for doc in docs:
+                labels = 'collection=%s,source=%s,pid="%d"' % (prometheus_label(doc['COLLECTION']),
+                                                               prometheus_label(doc['SOURCE'] or ''), doc['PID'])
+                f.write('%s{%s} %s\n' % (name, labels, repr(float(value(doc)))))
+
+
+def mark_refreshed():
+    # Stamp of the last load or refresh of the siope db: queries.py drops its cached results when it changes
+    get_connection().refresh.replace_one({'_id': REFRESH_ID}, {'_id': REFRESH_ID, 'RUN': run_id,
+                                                               'END': datetime.datetime.utcnow()}, upsert=True)
+
+
+def report_metrics(metrics_file=None, prometheus_file=None):
+    # Prints the summary of the processes of this run by collection,
+    # optionally written as JSON (metrics_file) and Prometheus text format (prometheus_file)
+    db = get_connection()
+    docs = list(db.metrics.find({'RUN': run_id}, {'_id': False}).sort('start', pymongo.ASCENDING))
+
+    names = []
+    for doc in docs:
+        if doc['COLLECTION'] not in names:
+            names.append(doc['COLLECTION'])
+    summaries = [summarize_metrics(name, [doc for doc in docs if doc['COLLECTION'] == name]) for name in names]
+
+    print('*** METRICS ***')
+    for s in summaries:
+        print('%s: %d workers, %d read, %d inserted, %d skipped, %.1f s, %.0f rows/s, %d bulks (%.3f s avg, %.3f s max)'
+              % (s['COLLECTION'], s['workers'], s['read'], s['inserted'], skipped(s), s['seconds'], s['rows_per_s'],
+                 s['bulks'], s['bulk_seconds'] / max(s['bulks'], 1), s['bulk_max_seconds']))
+
+    if metrics_file:
+        with open(metrics_file, 'w') as f:
+            json.dump({'RUN': run_id, 'COLLECTIONS': summaries}, f, indent=2, sort_keys=True)
+    if prometheus_file:
+        write_prometheus(prometheus_file, docs)
+
+
+def anagrafiche_files():
+    return sorted(find_sources('*ENTI_SIOPE*.csv') + find_sources('*_COMPARTI*.csv') +
+                  find_sources('*SOTTOCOMPARTI*.csv') + find_sources('*COMUNI*.csv') +
+                  find_sources('*REG_PROV*.csv') + find_sources('*CODGEST_*.csv'))
+
+
+def fingerprint_anagrafiche():
+    sha = hashlib.sha256()
+    paths = anagrafiche_files()
+    files = [os.path.basename(path) for path in paths]
+    for path in paths:
+        sha.update(os.path.basename(path).encode('utf-8'))
+        with open_source(path, binary=True) as f:
+            for line in f:
+                sha.update(line)
+    return {'_id': 'SIOPE_ANAGRAFICHE', 'SHA256': sha.hexdigest(), 'FILES': files}
+
+
+def csv_bytes(row):
+    # The fields of a csv row joined as bytes: they are bytes in Python 2, str in Python 3
+    line = ','.join(row)
+    return line if isinstance(line, bytes) else line.encode('utf-8')
+
+
+def fingerprint_facts(path):
+    # Hash and number of rows of the whole file and of each ANNO/PERIODO in it
+    sha = hashlib.sha256()
+    periods = {}
+    rows = 0
+    with open_source(path) as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                # blank line, skipped by csv.DictReader and so by the loaders
+                continue
+            line = csv_bytes(row)
+            sha.update(line)
+            rows += 1
+            # fields missing in a short row are None for csv.DictReader, 0 for to_int()
+            row += [''] * (len(FACT_FIELDNAMES) - len(row))
+            key = '%d/%d' % (to_int(row[1]), to_int(row[2]))
+            if key not in periods:
+                periods[key] = [hashlib.sha256(), 0]
+            periods[key][0].update(line)
+            periods[key][1] += 1
+
+    return {'_id': os.path.basename(path), 'SHA256': sha.hexdigest(), 'ROWS': rows,
+            'PERIODI': dict((key, {'SHA256': p[0].hexdigest(), 'ROWS': p[1]}) for key, p in periods.items())}
+
+
+def record_manifest(path):
+    # Stores in the manifest collection the fingerprint of a fact file or, if path is None, of the anagrafiche,
+    # unless it has one: a full load keeps the facts and enti already stored, so a file changed since it was
+    # fingerprinted still has to be replaced by --incremental
+    fingerprint = fingerprint_anagrafiche() if path is None else fingerprint_facts(path)
+    _id = fingerprint.pop('_id')
+    get_connection().manifest.update_one({'_id': _id}, {'$setOnInsert': fingerprint}, upsert=True)
+
+
+def changed_periods(old, new):
+    # (ANNO, PERIODO) whose rows were added, changed or removed
+    old_periods = old['PERIODI'] if old is not None else {}
+    changed = [key for key in new['PERIODI'] if old_periods.get(key) != new['PERIODI'][key]]
+    changed += [key for key in old_periods if key not in new['PERIODI']]
+    return set(tuple(int(x) for x in key.split('/')) for key in changed)
+
+
+def periods_query(periods):
+    return {'$or': [{'ANNO': anno, 'PERIODO': periodo} for anno, periodo in sorted(periods)]}
+
+
+def refresh_facts(kind, path, fingerprint, periods):
+    # Replaces the ANNO/PERIODO buckets of mdb_<kind> and mdb_<kind>_mensili loaded from path
+    print('REFRESHING mdb_%s and mdb_%s_mensili from %s: %d periods changed' % (kind, kind, path, len(periods)))
+    db = get_connection()
+    query = periods_query(periods)
+
+    db['mdb_' + kind].delete_many(query)
+    stream_facts_mdb(kind, path, periods)
+
+    db['mdb_%s_mensili' % kind].delete_many(query)
+    insert_timeseries(db['mdb_%s_mensili' % kind], db['mdb_' + kind].find(query).sort(FACT_KEY))
+
+    # the manifest is updated only when the buckets are replaced:
+    # an interrupted refresh is repeated by the next run
+    db.manifest.replace_one({'_id': fingerprint['_id']}, fingerprint, upsert=True)
+
+
+def reset_dimensions(anagrafiche_id):
+    # The anagrafiche changed: every fact file has to be refreshed and mdb_enti built again.
+    # A task, so that --resume does not drop the mdb_enti built by the interrupted run
+    db = get_connection()
+    db.manifest.delete_many({'_id': {'$ne': anagrafiche_id}})
+    db.mdb_enti.drop()
+
+
+def refresh_incremental(download=True):
+    # Returns the years with changed periods
+    print('*** INCREMENTAL REFRESH ***')
+    table_to_collection(download=download, facts=False)
+    db = get_connection()
+
+    anagrafiche = fingerprint_anagrafiche()
+    rebuild = db.manifest.find_one({'_id': anagrafiche['_id']}) != anagrafiche
+    if rebuild:
+        # every fact is joined with enti and codgest: all the periods have to be replaced
+        print('ANAGRAFICHE CHANGED: all the periods will be replaced')
+        build_dimensions(anagrafiche['_id'])
+
+    tasks = []
+    changed_years = set()
+    for kind in ('ENTRATE', 'USCITE'):
+        ensure_fact_key('mdb_' + kind.lower())
+        for path in fact_files(kind):
+            fingerprint = fingerprint_facts(path)
+            periods = changed_periods(db.manifest.find_one({'_id': fingerprint['_id']}), fingerprint)
+            if not periods:
+                print('%s unchanged' % path)
+                continue
+            changed_years.update(anno for anno, periodo in periods)
+            tasks.append(new_task('refresh/' + path, refresh_facts, (kind.lower(), path, fingerprint, periods)))
+            if export_dir is not None:
+                # the export of the file is rewritten as a whole
+                tasks.append(new_task('export/' + path, export_facts, (kind.lower(), path)))
+
+    run_tasks(tasks)
+    for name in ('mdb_entrate', 'mdb_uscite', 'mdb_entrate_mensili', 'mdb_uscite_mensili'):
+        build_indexes(name)
+
+    db.manifest.replace_one({'_id': anagrafiche['_id']}, anagrafiche, upsert=True)
+    return sorted(changed_years)
 
 
 def main():
+    global socket, siope_url, years, workers, direct, short_keys, engine, run_id, progress_interval
+    global batch_size, write_w, write_j, write_thread, shadow, export_dir, resume, max_memory
     print('SCRIPT STARTED AT:')
     start = datetime.datetime.today()
     print(start)
@@ -655,18 +2098,132 @@ def main():
     parser.add_argument('--download=True', action='store_true', dest='download', default=True,
                         help='(DEFAULT) Download data from Siope.it')
     parser.add_argument('--download=False', action='store_false', dest='download',
-                        help='Not download data from Siope.it, you must just have them in csvfiles directory')
+                        help='Not download data from Siope.it, you must just have them (zip or csv files) '
+                             'in csvfiles directory')
     parser.add_argument('--host', action='store', dest='host', default='localhost',
                         help='(DEFAULT: localhost) Hostname or IP address where mongod is running')
     parser.add_argument('--port', action='store', dest='port', default='27017',
                         help='(DEFAULT: 27017) Port used by mongod process')
+    parser.add_argument('--url', action='store', dest='url', default=siope_url,
+                        help='(DEFAULT: %s) Url where zip files are downloaded from' % siope_url)
+    parser.add_argument('--years', action='store', dest='years', nargs='+', default=['2016'],
+                        help='(DEFAULT: 2016) Years of ENTRATE and USCITE to download and load, '
+                             'e.g. --years 2010-2014 2016')
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=mp.cpu_count(),
+                        help='(DEFAULT: number of CPUs) Processes running at the same time, '
+                             'mdb_entrate and mdb_uscite are built in as many parts')
+    parser.add_argument('--direct', action='store_true', dest='direct', default=False,
+                        help='Load ENTRATE/USCITE csv files straight into mdb_entrate/mdb_uscite, '
+                             'without csv_entrate/csv_uscite')
+    parser.add_argument('--keep-staging', action='store_true', dest='staging', default=False,
+                        help='With --direct or --engine=pandas, load csv_entrate and csv_uscite too')
+    parser.add_argument('--short-keys', action='store_true', dest='short_keys', default=False,
+                        help='Store csv_entrate and csv_uscite documents with one letter keys')
+    parser.add_argument('--incremental', action='store_true', dest='incremental', default=False,
+                        help='Replace only the periods whose rows changed since the last run')
+    parser.add_argument('--rollups', action='store_true', dest='rollups', default=False,
+                        help='Step 4: store the yearly totals used by the *Rollup queries of queries.js')
+    parser.add_argument('--engine', action='store', dest='engine', default='python',
+                        choices=['python', 'server', 'pandas'],
+                        help='(DEFAULT: python) Where mdb_entrate/uscite are joined and mdb_*_mensili grouped: '
+                             'python, server (aggregation pipelines in mongod >= 4.2) or pandas (the csv files '
+                             'are joined a chunk of rows at a time, mdb_*_mensili are grouped in python)')
+    parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=batch_size,
+                        help='(DEFAULT: %d) Largest number of documents inserted at once, '
+                             'batches are smaller when documents are big or inserts are slow' % batch_size)
+    parser.add_argument('--w', action='store', dest='w', default=None,
+                        help='(DEFAULT: mongod default) Write concern of the inserts: a number of nodes '
+                             'or majority, 0 does not wait for acknowledgement (rows already stored are not counted)')
+    parser.add_argument('--j', action='store', dest='j', default=None, choices=['true', 'false'],
+                        help='(DEFAULT: mongod default) Wait for the journal before acknowledging an insert')
+    parser.add_argument('--write-thread', action='store_true', dest='write_thread', default=False,
+                        help='Insert each batch in a background thread while the next one is read')
+    parser.add_argument('--max-memory', action='store', dest='max_memory', type=int, default=None,
+                        help='(DEFAULT: no limit) Megabytes of memory of the --workers processes in all: batches, '
+                             'pandas chunks and enti/codgest lookups are sized to fit (mongod not included)')
+    parser.add_argument('--shadow', action='store_true', dest='shadow', default=False,
+                        help='Rebuild csv_*, mdb_codgest_* and mdb_*_mensili in shadow collections '
+                             'and swap them with the live ones when complete')
+    parser.add_argument('--export', action='store', dest='export', default=None,
+                        help='Write mdb_entrate and mdb_uscite also as Parquet files partitioned by year '
+                             'in this directory, for analytics without mongod (needs pyarrow)')
+    parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+                        help='Continue the last run if it did not end, with its options: the tasks it ended are '
+                             'skipped and the loaders restart after the last batch they inserted')
+    parser.add_argument('--progress', action='store', dest='progress', type=float, default=progress_interval,
+                        help='(DEFAULT: %d) Seconds between two progress lines of each loader' % progress_interval)
+    parser.add_argument('--metrics-file', action='store', dest='metrics_file', default=None,
+                        help='Write the metrics of the run in this JSON file')
+    parser.add_argument('--prometheus-file', action='store', dest='prometheus_file', default=None,
+                        help='Write the metrics of the run in this file, in Prometheus text format')
     result = parser.parse_args(sys.argv[1:])
-    global socket
+    # --host and --port of this command line, the other options of the run resumed
     socket = 'mongodb://' + result.host + ':' + result.port
+    run_id = start.isoformat()
+    interrupted = interrupted_run() if result.resume else None
+    if interrupted is not None:
+        print('RESUMING RUN %s: %s' % (interrupted['RUN'], ' '.join(interrupted['ARGS'])))
+        result = parser.parse_args(interrupted['ARGS'])
+        run_id = interrupted['RUN']
+        resume = True
+    elif result.resume:
+        print('NO INTERRUPTED RUN: starting a new one')
+    if result.engine == 'server' and result.direct:
+        parser.error('--engine=server joins csv_entrate and csv_uscite, it can not be used with --direct')
+    if result.j == 'true' and result.w == '0':
+        parser.error('--w 0 does not wait for acknowledgement, it can not be used with --j true')
+    if result.export:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            parser.error('--export needs the module pyarrow (pip install pyarrow)')
+    if result.engine == 'pandas':
+        try:
+            import pandas
+        except ImportError:
+            parser.error('--engine=pandas needs the module pandas (pip install pandas)')
+    siope_url = result.url
+    years = parse_years(result.years)
+    workers = max(1, result.workers)
+    direct = result.direct
+    short_keys = result.short_keys
+    engine = result.engine
+    batch_size = max(1, result.batch_size)
+    write_w = int(result.w) if result.w is not None and result.w.isdigit() else result.w
+    write_j = None if result.j is None else result.j == 'true'
+    write_thread = result.write_thread
+    shadow = result.shadow
+    progress_interval = result.progress
+    if result.max_memory is not None:
+        max_memory = result.max_memory * 1024 * 1024
+        if process_memory() < 2 * PROCESS_MEMORY:
+            parser.error('--max-memory %d leaves %d MB to each of %d processes, at least %d MB are needed: '
+                         'use fewer --workers' % (result.max_memory, max_memory // workers // (1024 * 1024), workers,
+                                                  (max_memory // workers - process_memory() + 2 * PROCESS_MEMORY)
+                                                  // (1024 * 1024)))
+    # files are written after table_to_collection() has moved in csvfiles
+    metrics_file = os.path.abspath(result.metrics_file) if result.metrics_file else None
+    prometheus_file = os.path.abspath(result.prometheus_file) if result.prometheus_file else None
+    export_dir = os.path.abspath(result.export) if result.export else None
     print('MongoDB socket:', socket)
-    table_to_collection(download=result.download)
-    build_collection_mdb()
-    build_timeseries()
+    if not resume:
+        start_journal([arg for arg in sys.argv[1:] if arg != '--resume'])
+    try:
+        if result.incremental:
+            changed_years = refresh_incremental(download=result.download)
+            if result.rollups:
+                build_rollups(changed_years)
+        else:
+            # steps 1-4 overlap
+            load_all(download=result.download, facts=staged_facts() or result.staging,
+                     rollup_years=years if result.rollups else None)
+    except RuntimeError as e:
+        print('RUN FAILED: %s' % e)
+        print('Run main.py --resume to continue it')
+        sys.exit(1)
+    mark_refreshed()
+    end_journal()
+    report_metrics(metrics_file, prometheus_file)
 
     print('SCRIPT ENDED AT:')
     end = datetime.datetime.today()
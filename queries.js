@@ -1,4 +1,8 @@
 var queries = new function() {
+    // TOTALE of a mdb_*_mensili document, summed from IMPORTI for the documents stored by older versions:
+    // the reports that are not split by categoria gestionale do not $unwind IMPORTI
+    var totale = {$ifNull : ['$TOTALE', {$sum : '$IMPORTI.IMPORTO'}]};
+
     var runTraced = function(command) {
         var before = new Date();
         print (command);
@@ -13,8 +17,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_uscite_mensili.aggregate([
                 {$match : {'ANNO' : anno}},
-                {$unwind : '$IMPORTI'},
-                {$group : {_id : {'ENTE' : '$DESCR_ENTE'}, 'Totale': {$sum : '$IMPORTI.IMPORTO'}}},
+                {$group : {_id : {'ENTE' : '$DESCR_ENTE'}, 'Totale': {$sum : totale}}},
                 {$sort : {'Totale' : -1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000000]}}},
                 {$project : {'Totale Miliardi €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -59,8 +62,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_entrate_mensili.aggregate([
                 {$match : {'ANNO' : anno}},
-                {$unwind : '$IMPORTI'},
-                {$group : {_id : {'ENTE' : '$DESCR_ENTE'}, 'Totale': {$sum : '$IMPORTI.IMPORTO'}}},
+                {$group : {_id : {'ENTE' : '$DESCR_ENTE'}, 'Totale': {$sum : totale}}},
                 {$sort : {'Totale' : -1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000000]}}},
                 {$project : {'Totale Miliardi €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -105,8 +107,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_uscite_mensili.aggregate([
                 {$match : {'ANNO':anno}},
-                {$unwind: '$IMPORTI'},
-                {$group : {'_id':{'REGIONE':'$DESCR_REGIONE'},'Totale':{$sum:'$IMPORTI.IMPORTO'}}},
+                {$group : {'_id':{'REGIONE':'$DESCR_REGIONE'},'Totale':{$sum:totale}}},
                 {$sort : {'Totale':-1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000000]}}},
                 {$project : {'Totale Miliardi €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -120,8 +121,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_entrate_mensili.aggregate([
                 {$match : {'ANNO':anno}},
-                {$unwind: '$IMPORTI'},
-                {$group : {'_id':{'REGIONE':'$DESCR_REGIONE'},'Totale':{$sum:'$IMPORTI.IMPORTO'}}},
+                {$group : {'_id':{'REGIONE':'$DESCR_REGIONE'},'Totale':{$sum:totale}}},
                 {$sort : {'Totale':-1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000000]}}},
                 {$project : {'Totale Miliardi €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -135,8 +135,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_uscite_mensili.aggregate([
                 {$match : {'ANNO':anno,'COD_COMPARTO':'SAN'}},
-                {$unwind: '$IMPORTI'},
-                {$group : {'_id':{'ENTE':'$DESCR_ENTE'},'Totale':{$sum:'$IMPORTI.IMPORTO'}}},
+                {$group : {'_id':{'ENTE':'$DESCR_ENTE'},'Totale':{$sum:totale}}},
                 {$sort : {'Totale':-1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000]}}},
                 {$project : {'Totale Milioni €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -171,8 +170,7 @@ var queries = new function() {
         return runTraced(function(){
             return db.mdb_entrate_mensili.aggregate([
                 {$match : {'ANNO':anno,'COD_COMPARTO':'SAN'}},
-                {$unwind: '$IMPORTI'},
-                {$group : {'_id':{'ENTE':'$DESCR_ENTE'},'Totale':{$sum:'$IMPORTI.IMPORTO'}}},
+                {$group : {'_id':{'ENTE':'$DESCR_ENTE'},'Totale':{$sum:totale}}},
                 {$sort : {'Totale':-1}},
                 {$project : {'Totale' : { $divide : ['$Totale', 100000000]}}},
                 {$project : {'Totale Milioni €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -237,9 +235,8 @@ var queries = new function() {
     return runTraced(function(){
         return db.mdb_uscite_mensili.aggregate([
                 {$match : {"ANNO" : anno}},
-                {$unwind : "$IMPORTI"},
                 {$group : {_id : {"Provincia" : "$DESCR_PROVINCIA"},
-                "Totale": {$sum : "$IMPORTI.IMPORTO"}}},
+                "Totale": {$sum : totale}}},
                 {$sort : {"Totale" : -1}},
                 {$project : {"Totale" : { $divide : ["$Totale", 100000000000]}}},
                 {$project : {"Totale Miliardi €" : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
@@ -273,12 +270,66 @@ var queries = new function() {
     return runTraced(function(){
         return db.mdb_uscite_mensili.aggregate([
                 {$match : {"ANNO" : anno}},
-                {$unwind : "$IMPORTI"},
-                {$group :{_id : {"SOTTOCOMPARTO" : "$DESCR_SOTTOCOMPARTO"},
-                "Totale": {$sum : "$IMPORTI.IMPORTO"}}},
+                {$group : {_id : {"SOTTOCOMPARTO" : "$DESCR_SOTTOCOMPARTO"},
+                "Totale": {$sum : totale}}},
                 {$sort : {"Totale" : -1}},
                 {$project : {"Totale" : { $divide : ["$Totale", 100000000000]}}},
                 {$project : {"Totale Miliardi €" : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
                 {$mod:[{$multiply:['$Totale',100]}, 1]}]},100]}}}]);
         })};
+
+    // The following queries read the totals stored by main.py --rollups (step 4)
+    // in mdb_uscite_rollup and mdb_entrate_rollup: they don't $unwind IMPORTI
+
+    var rollup = function(collection, dimensione, anno) {
+        return runTraced(function(){
+            return db.getCollection(collection).aggregate([
+                {$match : {'DIMENSIONE' : dimensione, 'ANNO' : anno}},
+                {$sort : {'TOTALE' : -1}},
+                {$project : {_id : 0, 'VALORE' : 1, 'Totale' : { $divide : ['$TOTALE', 100000000000]}}},
+                {$project : {'VALORE' : 1, 'Totale Miliardi €' : {$divide:[{$subtract:[{$multiply:['$Totale',100]},
+                {$mod:[{$multiply:['$Totale',100]}, 1]}]},100]}}}
+                ]);
+        })
+    };
+
+    this.uscitePerEnteRollup = function(anno) {
+        return rollup('mdb_uscite_rollup', 'ENTE', anno);
+    };
+
+    this.entratePerEnteRollup = function(anno) {
+        return rollup('mdb_entrate_rollup', 'ENTE', anno);
+    };
+
+    this.uscitePerRegioneRollup = function(anno) {
+        return rollup('mdb_uscite_rollup', 'REGIONE', anno);
+    };
+
+    this.entratePerRegioneRollup = function(anno) {
+        return rollup('mdb_entrate_rollup', 'REGIONE', anno);
+    };
+
+    this.uscitePerProvincieRollup = function(anno) {
+        return rollup('mdb_uscite_rollup', 'PROVINCIA', anno);
+    };
+
+    this.entratePerProvincieRollup = function(anno) {
+        return rollup('mdb_entrate_rollup', 'PROVINCIA', anno);
+    };
+
+    this.uscitePerSottoCompartiRollup = function(anno) {
+        return rollup('mdb_uscite_rollup', 'SOTTOCOMPARTO', anno);
+    };
+
+    this.entratePerSottoCompartiRollup = function(anno) {
+        return rollup('mdb_entrate_rollup', 'SOTTOCOMPARTO', anno);
+    };
+
+    this.uscitePerCategoriaGestionaleRollup = function(anno) {
+        return rollup('mdb_uscite_rollup', 'CATEGORIA', anno);
+    };
+
+    this.entratePerCategoriaGestionaleRollup = function(anno) {
+        return rollup('mdb_entrate_rollup', 'CATEGORIA', anno);
+    };
 };
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "Reports of queries.js for Python programs, with a cache of their results"
+
+__author__ = "Massimiliano Scotti"
+__license__ = "MIT License"
+
+import argparse
+import collections
+import json
+import sys
+import threading
+import time
+
+import main
+
+# FUNCTIONS
+
+# uscite_per_ente(), entrate_per_regione(), ...: the reports of queries.js, same pipelines and parameters
+# (uscitePerEnte(anno) is uscite_per_ente(anno)). They return a list of documents, shared with the cache:
+# do not modify it. The *MR reports are not ported: mapReduce returns the same totals as the aggregations.
+# As in queries.js, the reports not split by categoria gestionale sum the TOTALE of mdb_*_mensili documents
+
+# run_query(): runs a pipeline, or returns its cached result
+# Results are cached for cache_ttl seconds, at most cache_size of them (least recently used are dropped),
+# and dropped when main.py ends a load or refresh of the siope db (mark_refreshed() in main.py)
+
+# query_metrics(), write_prometheus(): calls, cache hits and execution time of each report,
+# the runTraced timer of queries.js
+
+# Results kept at most this number of seconds
+cache_ttl = 600.0
+
+# Number of results kept
+cache_size = 128
+
+# Seconds between two reads of the refresh stamp written by main.py
+REFRESH_CHECK = 5.0
+
+# Print each pipeline run and its execution time, as runTraced
+trace = False
+
+# (query, args) -> (time, documents), least recently used first
+cache = collections.OrderedDict()
+
+# refresh stamp the cached results were computed on, time it was read
+cache_refresh = None
+refresh_checked_at = 0.0
+
+# queries run by dashboards may share the cache between threads
+cache_lock = threading.Lock()
+
+# query -> counters
+metrics = {}
+
+MILIARDI = 100000000000
+MILIONI = 100000000
+
+
+def new_query_metrics(query):
+    return {'QUERY': query, 'calls': 0, 'hits': 0, 'executions': 0, 'documents': 0,
+            'seconds': 0.0, 'max_seconds': 0.0, 'last_seconds': None}
+
+
+def invalidate():
+    # Drops every cached result
+    with cache_lock:
+        cache.clear()
+
+
+def check_refresh():
+    # Drops the cached results if main.py ended a load or refresh since they were computed.
+    # The stamp is read at most every REFRESH_CHECK seconds
+    global cache_refresh, refresh_checked_at
+    now = time.time()
+    if now - refresh_checked_at < REFRESH_CHECK:
+        return
+    refresh_checked_at = now
+    stamp = main.get_connection().refresh.find_one({'_id': main.REFRESH_ID})
+    if stamp != cache_refresh:
+        cache_refresh = stamp
+        invalidate()
+
+
+def cached(key):
+    # Cached documents of key, None if missing or expired
+    with cache_lock:
+        entry = cache.pop(key, None)
+        if entry is None or time.time() - entry[0] > cache_ttl:
+            return None
+        # most recently used
+        cache[key] = entry
+        return entry[1]
+
+
+def store(key, documents):
+    with cache_lock:
+        cache.pop(key, None)
+        cache[key] = (time.time(), documents)
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+
+def run_query(query, args, collection, pipeline):
+    # query and args are the name and parameters of the report, the key of its cached result
+    key = (query,) + tuple(args)
+    stats = metrics.setdefault(query, new_query_metrics(query))
+    stats['calls'] += 1
+
+    check_refresh()
+    documents = cached(key)
+    if documents is not None:
+        stats['hits'] += 1
+        return documents
+
+    start = time.time()
+    documents = list(main.get_connection()[collection].aggregate(pipeline))
+    seconds = time.time() - start
+    store(key, documents)
+
+    stats['executions'] += 1
+    stats['documents'] += len(documents)
+    stats['seconds'] += seconds
+    stats['max_seconds'] = max(stats['max_seconds'], seconds)
+    stats['last_seconds'] = seconds
+    if trace:
+        print('%s%r on %s' % (query, tuple(args), collection))
+        print('Execution time: %d ms' % (seconds * 1000))
+    return documents
+
+
+def totale(label, divisor, fields=()):
+    # Totale in billions (MILIARDI) or millions (MILIONI) of euros, truncated to 2 decimals, as label.
+    # fields are kept too
+    keep = dict((field, 1) for field in fields)
+    divided = dict(keep, Totale={'$divide': ['$Totale', divisor]})
+    cents = {'$multiply': ['$Totale', 100]}
+    truncated = dict(keep)
+    truncated[label] = {'$divide': [{'$subtract': [cents, {'$mod': [cents, 1]}]}, 100]}
+    return [{'$project': divided}, {'$project': truncated}]
+
+
+def totale_per(query, args, collection, match, group_by, field, label, divisor, limit=None, categoria=None):
+    # Sum of the IMPORTI of collection (mdb_*_mensili) matching match, by the value of field (group_by):
+    # the TOTALE of each document. With categoria only the IMPORTI of this categoria gestionale are summed
+    if categoria is None:
+        pipeline = [{'$match': match},
+                    {'$group': {'_id': {group_by: field}, 'Totale': {'$sum': main.MENSILI_TOTALE}}}]
+    else:
+        pipeline = [{'$match': match}, {'$unwind': '$IMPORTI'}, {'$match': {'IMPORTI.DESCRIZIONE_CG': categoria}},
+                    {'$group': {'_id': {group_by: field}, 'Totale': {'$sum': '$IMPORTI.IMPORTO'}}}]
+    pipeline.append({'$sort': {'Totale': -1}})
+    pipeline += totale(label, divisor)
+    if limit is not None:
+        pipeline.append({'$limit': limit})
+    return run_query(query, args, collection, pipeline)
+
+
+def totale_per_slow(query, args, collection, match, group_by, field, label, divisor):
+    # As totale_per(), on the facts of mdb_entrate/mdb_uscite
+    pipeline = [{'$match': match},
+                {'$group': {'_id': {group_by: field}, 'Totale': {'$sum': '$IMPORTO'}}},
+                {'$sort': {'Totale': -1}}]
+    return run_query(query, args, collection, pipeline + totale(label, divisor))
+
+
+def uscite_per_ente(anno):
+    return totale_per('uscite_per_ente', [anno], 'mdb_uscite_mensili', {'ANNO': anno},
+                      'ENTE', '$DESCR_ENTE', 'Totale Miliardi €', MILIARDI)
+
+
+def uscite_per_ente_slow(anno):
+    return totale_per_slow('uscite_per_ente_slow', [anno], 'mdb_uscite', {'ANNO': anno},
+                           'ENTE', '$DESCR_ENTE', 'Totale Miliardi €', MILIARDI)
+
+
+def entrate_per_ente(anno):
+    return totale_per('entrate_per_ente', [anno], 'mdb_entrate_mensili', {'ANNO': anno},
+                      'ENTE', '$DESCR_ENTE', 'Totale Miliardi €', MILIARDI)
+
+
+def entrate_per_ente_slow(anno):
+    return totale_per_slow('entrate_per_ente_slow', [anno], 'mdb_entrate', {'ANNO': anno},
+                           'ENTE', '$DESCR_ENTE', 'Totale Miliardi €', MILIARDI)
+
+
+def uscite_per_regione(anno):
+    return totale_per('uscite_per_regione', [anno], 'mdb_uscite_mensili', {'ANNO': anno},
+                      'REGIONE', '$DESCR_REGIONE', 'Totale Miliardi €', MILIARDI, limit=20)
+
+
+def entrate_per_regione(anno):
+    return totale_per('entrate_per_regione', [anno], 'mdb_entrate_mensili', {'ANNO': anno},
+                      'REGIONE', '$DESCR_REGIONE', 'Totale Miliardi €', MILIARDI, limit=20)
+
+
+def uscite_sanita_per_ente(anno):
+    return totale_per('uscite_sanita_per_ente', [anno], 'mdb_uscite_mensili', {'ANNO': anno, 'COD_COMPARTO': 'SAN'},
+                      'ENTE', '$DESCR_ENTE', 'Totale Milioni €', MILIONI, limit=20)
+
+
+def entrate_sanita_per_ente(anno):
+    return totale_per('entrate_sanita_per_ente', [anno], 'mdb_entrate_mensili',
+                      {'ANNO': anno, 'COD_COMPARTO': 'SAN'}, 'ENTE', '$DESCR_ENTE', 'Totale Milioni €', MILIONI,
+                      limit=20)
+
+
+def dettaglio(query, args, collection, importo_prefix):
+    # Totals of an ente by categoria gestionale, importo_prefix is 'IMPORTI.' for mdb_uscite_mensili
+    anno, descrizione_ente = args
+    pipeline = [{'$match': {'ANNO': anno, 'DESCR_ENTE': descrizione_ente}}]
+    if importo_prefix:
+        pipeline.append({'$unwind': '$IMPORTI'})
+    pipeline += [{'$group': {'_id': {'CATEGORIA': '$%sDESCRIZIONE_CG' % importo_prefix},
+                             'Totale': {'$sum': '$%sIMPORTO' % importo_prefix}}},
+                 {'$sort': {'Totale': -1}},
+                 {'$project': {'_id': 0, 'CATEGORIA': '$_id.CATEGORIA', 'Totale': 1}}]
+    return run_query(query, args, collection, pipeline + totale('Totale milioni €', MILIONI, ['CATEGORIA']))
+
+
+def uscite_per_ente_dettaglio(anno, descrizione_ente):
+    return dettaglio('uscite_per_ente_dettaglio', [anno, descrizione_ente], 'mdb_uscite_mensili', 'IMPORTI.')
+
+
+def uscite_per_ente_dettaglio_slow(anno, descrizione_ente):
+    return dettaglio('uscite_per_ente_dettaglio_slow', [anno, descrizione_ente], 'mdb_uscite', '')
+
+
+def comparti():
+    return run_query('comparti', [], 'csv_comparti',
+                     [{'$group': {'_id': {'COD': '$COD_COMPARTO', 'DESCR': '$DESCRIZIONE_COMPARTO'}}}])
+
+
+def sottocomparti():
+    return run_query('sottocomparti', [], 'csv_sottocomparti',
+                     [{'$group': {'_id': {'COD': '$SOTTOCOMPARTO', 'DESCR': '$DESCRIZIONE'}}}])
+
+
+def comparti_and_sottocomparti():
+    return run_query('comparti_and_sottocomparti', [], 'mdb_enti',
+                     [{'$group': {'_id': {'CC': '$COD_COMPARTO', 'DC': '$DESCR_COMPARTO',
+                                          'CS': '$COD_SOTTOCOMPARTO', 'DS': '$DESCR_SOTTOCOMPARTO'}}},
+                      {'$sort': {'_id.CC': 1}}])
+
+
+def uscite_per_ente_per_categoria_gestionale(anno, descrizione_categoria):
+    return totale_per('uscite_per_ente_per_categoria_gestionale', [anno, descrizione_categoria],
+                      'mdb_uscite_mensili', {'ANNO': anno},
+                      'ENTE', '$DESCR_ENTE', 'Totale milioni €', MILIONI, categoria=descrizione_categoria)
+
+
+def uscite_per_regioni_per_categoria_gestionale(anno, descrizione_categoria):
+    return totale_per('uscite_per_regioni_per_categoria_gestionale', [anno, descrizione_categoria],
+                      'mdb_uscite_mensili', {'ANNO': anno},
+                      'REGIONE', '$DESCR_REGIONE', 'Totale milioni €', MILIONI, categoria=descrizione_categoria)
+
+
+def uscite_per_provincie(anno):
+    return totale_per('uscite_per_provincie', [anno], 'mdb_uscite_mensili', {'ANNO': anno},
+                      'Provincia', '$DESCR_PROVINCIA', 'Totale Miliardi €', MILIARDI)
+
+
+def uscite_per_provincie_per_categoria_gestionale(anno, descrizione_categoria):
+    return totale_per('uscite_per_provincie_per_categoria_gestionale', [anno, descrizione_categoria],
+                      'mdb_uscite_mensili', {'ANNO': anno},
+                      'Provincia', '$DESCR_PROVINCIA', 'Totale milioni €', MILIONI, categoria=descrizione_categoria)
+
+
+def uscite_per_categoria_gestionale(anno):
+    pipeline = [{'$match': {'ANNO': anno}},
+                {'$unwind': '$IMPORTI'},
+                {'$group': {'_id': {'CATEGORIA': '$IMPORTI.DESCRIZIONE_CG'}, 'Totale': {'$sum': '$IMPORTI.IMPORTO'}}},
+                {'$sort': {'Totale': -1}},
+                {'$project': {'_id': 0, 'CATEGORIA': '$_id.CATEGORIA', 'Totale': 1}}]
+    return run_query('uscite_per_categoria_gestionale', [anno], 'mdb_uscite_mensili',
+                     pipeline + totale('Totale Miliardi €', MILIARDI, ['CATEGORIA']))
+
+
+def uscite_per_sotto_comparti(anno):
+    return totale_per('uscite_per_sotto_comparti', [anno], 'mdb_uscite_mensili', {'ANNO': anno},
+                      'SOTTOCOMPARTO', '$DESCR_SOTTOCOMPARTO', 'Totale Miliardi €', MILIARDI)
+
+
+# The following reports read the totals stored by main.py --rollups (step 4)
+# in mdb_uscite_rollup and mdb_entrate_rollup: they don't $unwind IMPORTI
+
+def rollup(query, collection, dimensione, anno):
+    pipeline = [{'$match': {'DIMENSIONE': dimensione, 'ANNO': anno}},
+                {'$sort': {'TOTALE': -1}},
+                {'$project': {'_id': 0, 'VALORE': 1, 'Totale': '$TOTALE'}}]
+    return run_query(query, [anno], collection, pipeline + totale('Totale Miliardi €', MILIARDI, ['VALORE']))
+
+
+def uscite_per_ente_rollup(anno):
+    return rollup('uscite_per_ente_rollup', 'mdb_uscite_rollup', 'ENTE', anno)
+
+
+def entrate_per_ente_rollup(anno):
+    return rollup('entrate_per_ente_rollup', 'mdb_entrate_rollup', 'ENTE', anno)
+
+
+def uscite_per_regione_rollup(anno):
+    return rollup('uscite_per_regione_rollup', 'mdb_uscite_rollup', 'REGIONE', anno)
+
+
+def entrate_per_regione_rollup(anno):
+    return rollup('entrate_per_regione_rollup', 'mdb_entrate_rollup', 'REGIONE', anno)
+
+
+def uscite_per_provincie_rollup(anno):
+    return rollup('uscite_per_provincie_rollup', 'mdb_uscite_rollup', 'PROVINCIA', anno)
+
+
+def entrate_per_provincie_rollup(anno):
+    return rollup('entrate_per_provincie_rollup', 'mdb_entrate_rollup', 'PROVINCIA', anno)
+
+
+def uscite_per_sotto_comparti_rollup(anno):
+    return rollup('uscite_per_sotto_comparti_rollup', 'mdb_uscite_rollup', 'SOTTOCOMPARTO', anno)
+
+
+def entrate_per_sotto_comparti_rollup(anno):
+    return rollup('entrate_per_sotto_comparti_rollup', 'mdb_entrate_rollup', 'SOTTOCOMPARTO', anno)
+
+
+def uscite_per_categoria_gestionale_rollup(anno):
+    return rollup('uscite_per_categoria_gestionale_rollup', 'mdb_uscite_rollup', 'CATEGORIA', anno)
+
+
+def entrate_per_categoria_gestionale_rollup(anno):
+    return rollup('entrate_per_categoria_gestionale_rollup', 'mdb_entrate_rollup', 'CATEGORIA', anno)
+
+
+# Reports run by the command line
+REPORTS = dict((report.__name__, report) for report in [
+    uscite_per_ente, uscite_per_ente_slow, entrate_per_ente, entrate_per_ente_slow,
+    uscite_per_regione, entrate_per_regione, uscite_sanita_per_ente, entrate_sanita_per_ente,
+    uscite_per_ente_dettaglio, uscite_per_ente_dettaglio_slow, comparti, sottocomparti, comparti_and_sottocomparti,
+    uscite_per_ente_per_categoria_gestionale, uscite_per_regioni_per_categoria_gestionale, uscite_per_provincie,
+    uscite_per_provincie_per_categoria_gestionale, uscite_per_categoria_gestionale, uscite_per_sotto_comparti,
+    uscite_per_ente_rollup, entrate_per_ente_rollup, uscite_per_regione_rollup, entrate_per_regione_rollup,
+    uscite_per_provincie_rollup, entrate_per_provincie_rollup, uscite_per_sotto_comparti_rollup,
+    entrate_per_sotto_comparti_rollup, uscite_per_categoria_gestionale_rollup,
+    entrate_per_categoria_gestionale_rollup])
+
+
+def query_metrics():
+    # Counters of each report, with the average execution time and the fraction of calls served by the cache
+    docs = []
+    for query in sorted(metrics):
+        doc = dict(metrics[query])
+        doc['avg_seconds'] = doc['seconds'] / doc['executions'] if doc['executions'] else None
+        doc['hit_ratio'] = float(doc['hits']) / doc['calls'] if doc['calls'] else None
+        docs.append(doc)
+    return docs
+
+
+def write_prometheus(path):
+    # Text file for the textfile collector of node_exporter, one series for each report
+    series = [('siope_query_calls_total', 'counter', 'Calls of the report', 'calls'),
+              ('siope_query_cache_hits_total', 'counter', 'Calls served by the cache', 'hits'),
+              ('siope_query_executions_total', 'counter', 'Pipelines run in mongod', 'executions'),
+              ('siope_query_seconds_total', 'counter', 'Time spent running the pipeline', 'seconds'),
+              ('siope_query_max_seconds', 'gauge', 'Slowest run of the pipeline', 'max_seconds')]
+    docs = query_metrics()
+    with open(path, 'w') as f:
+        for name, kind, description, field in series:
+            f.write('# HELP %s %s\n# TYPE %s %s\n' % (name, description, name, kind))
+            for doc in docs:
+                f.write('%s{query=%s} %s\n' % (name, main.prometheus_label(doc['QUERY']), repr(float(doc[field]))))
+
+
+def parse_arg(value):
+    # ANNO is a number, the descriptions are strings
+    return int(value) if value.isdigit() else value
+
+
+def main_queries():
+    global trace
+    parser = argparse.ArgumentParser(description='Run a report of queries.js on the siope db')
+    parser.add_argument('query', choices=sorted(REPORTS), metavar='report', help='Report, e.g. uscite_per_ente')
+    parser.add_argument('args', nargs='*', help='Parameters of the report, e.g. 2015')
+    parser.add_argument('--host', action='store', dest='host', default='localhost',
+                        help='(DEFAULT: localhost) Hostname or IP address where mongod is running')
+    parser.add_argument('--port', action='store', dest='port', default='27017',
+                        help='(DEFAULT: 27017) Port used by mongod process')
+    result = parser.parse_args(sys.argv[1:])
+    main.socket = 'mongodb://' + result.host + ':' + result.port
+    trace = True
+
+    for doc in REPORTS[result.query](*[parse_arg(arg) for arg in result.args]):
+        print(json.dumps(doc, default=str, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main_queries()
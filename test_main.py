@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# "Tests of main.py on synthetic SIOPE data and mongomock (pip install mongomock)"
+
+__author__ = "Massimiliano Scotti"
+__license__ = "MIT License"
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+try:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import benchmark
+import main
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def run_main(*args):
+    # main.py with args, from the directory containing csvfiles
+    sys.argv = ['main.py', '--download=False', '--workers', '2'] + list(args)
+    main.main()
+
+
+def write_settings(path):
+    # Task of SettingsTest, run in a spawned process
+    with open(path, 'w') as f:
+        json.dump(main.settings(), f)
+
+
+class MainTestCase(unittest.TestCase):
+    # Every test runs in a temporary directory with its own mongomock database, every process of main.py inline
+
+    def setUp(self):
+        self.globals = dict(vars(main))
+        self.argv = sys.argv
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        benchmark.generate(os.path.join(self.directory, 'csvfiles'), 20, 10, [2016], 500)
+        benchmark.use_mongomock(benchmark.Counter())
+        self.db = main.get_connection()
+        for name in self.db.list_collection_names():
+            self.db[name].drop()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.argv = self.argv
+        vars(main).update(self.globals)
+        shutil.rmtree(self.directory)
+
+    def rewrite_member(self, archive, member, old, new):
+        # Replaces old with new in a csv file of a zip archive of csvfiles
+        path = os.path.join(self.directory, 'csvfiles', archive)
+        with zipfile.ZipFile(path) as zfile:
+            members = dict((name, zfile.read(name)) for name in zfile.namelist())
+        members[member] = members[member].replace(old, new)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            for name, data in sorted(members.items()):
+                zfile.writestr(name, data)
+
+
+class IncrementalTest(MainTestCase):
+
+    def test_resume_failed_refresh(self):
+        # A refresh of changed anagrafiche fails after mdb_enti is rebuilt: --resume must not drop it again
+        run_main()
+        enti = self.db.mdb_enti.count_documents({})
+        uscite = self.db.mdb_uscite.count_documents({})
+        self.assertTrue(enti > 0 and uscite > 0)
+
+        self.rewrite_member('SIOPE_ANAGRAFICHE.zip', 'ANAG_COMPARTI.csv', b'Comparto SAN', b'Comparto Sanita')
+        refresh_facts = main.refresh_facts
+
+        def failing(kind, path, fingerprint, periods):
+            if kind == 'uscite':
+                raise ValueError('refresh of %s failed' % path)
+            refresh_facts(kind, path, fingerprint, periods)
+        main.refresh_facts = failing
+        os.chdir(self.directory)
+        self.assertRaises(ValueError, run_main, '--incremental')
+
+        main.refresh_facts = refresh_facts
+        main.resume = False
+        os.chdir(self.directory)
+        run_main('--resume')
+
+        self.assertEqual(self.db.mdb_enti.count_documents({}), enti)
+        self.assertEqual(self.db.mdb_enti.count_documents({'DESCR_COMPARTO': 'Comparto Sanita'}),
+                         self.db.mdb_enti.count_documents({'COD_COMPARTO': 'SAN'}))
+        self.assertEqual(self.db.mdb_uscite.count_documents({}), uscite)
+        self.assertTrue(self.db.mdb_uscite.count_documents({'DESCR_COMPARTO': 'Comparto Sanita'}) > 0)
+        self.assertEqual(self.db.mdb_uscite.count_documents({'DESCR_COMPARTO': 'Comparto SAN'}), 0)
+
+
+class OptionsTest(MainTestCase):
+
+    def test_write_concern(self):
+        # rejected by argparse, before pymongo
+        self.assertRaises(SystemExit, run_main, '--j', 'true', '--w', '0')
+        self.assertEqual(self.db.list_collection_names(), [])
+
+
+class ResumeTest(MainTestCase):
+
+    def fail_inserts(self, name, batch):
+        # The batch-th insert in collection name raises ValueError
+        insert_batch = main.insert_batch
+        calls = [0]
+
+        def failing(collection, documents, stats):
+            if collection.name == name:
+                calls[0] += 1
+                if calls[0] == batch:
+                    raise ValueError('insert in %s failed' % name)
+            return insert_batch(collection, documents, stats)
+        main.insert_batch = failing
+        return insert_batch
+
+    def facts(self, name):
+        return sorted((doc['_id'], doc['IMPORTO']) for doc in self.db[name].find())
+
+    @unittest.skipIf(pd is None, 'no pandas')
+    def test_resume_pandas_blank_lines(self):
+        # positions count the rows without the blank lines: --resume skips exactly the rows inserted
+        self.rewrite_member('SIOPE_USCITE.2016.zip', 'USCITE_2016.csv', b'\n', b'\n\n')
+        run_main('--engine', 'pandas', '--batch-size', '40')
+        expected = self.facts('mdb_uscite')
+        for name in self.db.list_collection_names():
+            self.db[name].drop()
+
+        insert_batch = self.fail_inserts('mdb_uscite', 3)
+        os.chdir(self.directory)
+        self.assertRaises(ValueError, run_main, '--engine', 'pandas', '--batch-size', '40')
+        self.assertTrue(0 < len(self.facts('mdb_uscite')) < len(expected))
+
+        main.insert_batch = insert_batch
+        main.resume = False
+        os.chdir(self.directory)
+        run_main('--resume')
+        self.assertEqual(self.facts('mdb_uscite'), expected)
+        stats = self.db.metrics.find_one({'COLLECTION': 'mdb_uscite'})
+        self.assertEqual(stats['duplicates'], 0)
+
+
+class PartitionTest(MainTestCase):
+
+    def test_ranges(self):
+        # the ranges of partition_queries() hold every document once, in parts of about the same size
+        run_main('--direct', '--keep-staging')
+        total = self.db.csv_uscite.count_documents({})
+        for parts in (1, 3, 4):
+            main.partition_by_id('uscite', parts)
+            sizes = [self.db.csv_uscite.count_documents(query) for query in main.partition_queries('uscite')]
+            self.assertEqual(len(sizes), parts)
+            self.assertEqual(sum(sizes), total)
+            self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+
+class SettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.globals = dict(vars(main))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        vars(main).update(self.globals)
+        shutil.rmtree(self.directory)
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'get_context'), 'no spawn start method')
+    def test_spawn(self):
+        # a spawned process imports main again: the settings of main() must reach it all the same
+        main.mp = multiprocessing.get_context('spawn')
+        # journal_done() fails at once, after the task
+        main.socket = 'mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100'
+        main.engine = 'pandas'
+        main.short_keys = True
+        main.batch_size = 7
+        main.years = [2015, 2016]
+        main.run_id = 'spawned'
+        path = os.path.join(self.directory, 'settings.json')
+        self.assertRaises(RuntimeError, main.run_tasks, [main.new_task('settings', write_settings, (path,))])
+        with open(path) as f:
+            self.assertEqual(json.load(f), json.loads(json.dumps(main.settings())))
+
+
+class SiopeServer(ThreadingMixIn, HTTPServer):
+    # Stand-in for siope.it: files maps paths to contents, sent with an ETag and,
+    # for If-Range requests with the current ETag, from the Range offset
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SiopeHandler)
+        self.files = {}
+        # (path, headers) of each request
+        self.requests = []
+        # paths whose next response is cut after TRUNCATE bytes
+        self.truncate = set()
+        # seconds each response waits before its body, requests served at the same time (peak)
+        self.delay = 0.0
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+
+
+class SiopeHandler(BaseHTTPRequestHandler):
+    TRUNCATE = 1000
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict((k.lower(), v) for k, v in self.headers.items())))
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            self.send_file(server.files.get(self.path))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def send_file(self, body):
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if self.path in self.server.truncate:
+            self.server.truncate.discard(self.path)
+            self.wfile.write(body[start:start + self.TRUNCATE])
+            return
+        self.wfile.write(body[start:])
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.globals = dict(vars(main))
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.server = SiopeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        vars(main).update(self.globals)
+        shutil.rmtree(self.directory)
+
+    def download(self, name, cache):
+        # main.download() of a file of the server, returns its result and the requests it sent
+        del self.server.requests[:]
+        changed = main.download(self.server.url + name, name, cache)
+        return changed, [headers for path, headers in self.server.requests]
+
+    def read(self, name):
+        with open(name, 'rb') as f:
+            return f.read()
+
+    def test_not_modified(self):
+        self.server.files['/SIOPE_ANAGRAFICHE.zip'] = os.urandom(5000)
+        cache = {}
+        self.assertEqual(self.download('SIOPE_ANAGRAFICHE.zip', cache)[0], True)
+
+        changed, requests = self.download('SIOPE_ANAGRAFICHE.zip', cache)
+        self.assertEqual(changed, False)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0]['if-none-match'], cache['SIOPE_ANAGRAFICHE.zip']['ETag'])
+
+        self.server.files['/SIOPE_ANAGRAFICHE.zip'] = os.urandom(3000)
+        self.assertEqual(self.download('SIOPE_ANAGRAFICHE.zip', cache)[0], True)
+        self.assertEqual(self.read('SIOPE_ANAGRAFICHE.zip'), self.server.files['/SIOPE_ANAGRAFICHE.zip'])
+
+    def test_resume(self):
+        # the first response is cut: the second request asks for the rest of the same file
+        self.server.files['/SIOPE_USCITE.2016.zip'] = os.urandom(5000)
+        self.server.truncate.add('/SIOPE_USCITE.2016.zip')
+        main.time.sleep, sleep = (lambda seconds: None), main.time.sleep
+        try:
+            changed, requests = self.download('SIOPE_USCITE.2016.zip', {})
+        finally:
+            main.time.sleep = sleep
+        self.assertEqual(changed, True)
+        self.assertEqual(len(requests), 2)
+        self.assertNotIn('range', requests[0])
+        self.assertEqual(requests[1]['range'], 'bytes=%d-' % SiopeHandler.TRUNCATE)
+        self.assertTrue(requests[1]['if-range'])
+        self.assertEqual(self.read('SIOPE_USCITE.2016.zip'), self.server.files['/SIOPE_USCITE.2016.zip'])
+        self.assertFalse(os.path.exists('SIOPE_USCITE.2016.zip.part'))
+
+    def test_client_error(self):
+        # 4xx responses are not retried
+        changed, requests = self.download('SIOPE_USCITE.2099.zip', {})
+        self.assertEqual(changed, False)
+        self.assertEqual(len(requests), 1)
+        self.assertFalse(os.path.exists('SIOPE_USCITE.2099.zip'))
+
+    def test_downloads_at_the_same_time(self):
+        main.years = list(range(2007, 2017))
+        names = ['SIOPE_ANAGRAFICHE.zip'] + ['SIOPE_%s.%d.zip' % (kind, year)
+                                            for year in main.years for kind in ('ENTRATE', 'USCITE')]
+        for name in names:
+            self.server.files['/' + name] = os.urandom(1000)
+        self.server.delay = 0.05
+        main.retrieve_data(self.server.url)
+        self.assertTrue(1 < self.server.peak <= main.DOWNLOADS)
+        for name in names:
+            self.assertEqual(self.read(name), self.server.files['/' + name])
+
+
+if __name__ == '__main__':
+    unittest.main()